@@ -0,0 +1,32 @@
+"""Simulation level of detail for Umbrella Rogue.
+
+Monsters only do anything when the player is about, so only those near the
+player are given turns. An ActiveSet holds them. Each turn it is replaced
+with the result of a spatial index query around the player, and the
+monsters not in it before are returned as newly woken. Monsters that drop
+out go dormant and simply stop taking turns; timed state such as confusion
+runs off the turn scheduler, so it needs no turns to wear off.
+"""
+
+
+class ActiveSet:
+    """Objects near enough to the player to take turns."""
+    def __init__(self):
+        self._active = set()
+
+    def __len__(self):
+        return len(self._active)
+
+    def __contains__(self, obj):
+        return obj in self._active
+
+    def update(self, nearby):
+        """Make the objects nearby the active ones; return those that woke."""
+        nearby = set(nearby)
+        woken = list(nearby - self._active)
+        self._active = nearby
+        return woken
+
+    def discard(self, obj):
+        """Forget obj, e.g. because it died."""
+        self._active.discard(obj)
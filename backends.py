@@ -0,0 +1,179 @@
+"""Display and input backends for Umbrella Rogue.
+
+main.py draws and reads input through a backend instead of calling tdl
+directly. TdlBackend opens the real window; NullBackend needs no display and
+feeds the game input from a scripted source, so the game logic can run (and
+be profiled) at full CPU speed on machines without a screen.
+"""
+import tdl
+from tcod import image_load
+from tcod import (console_fill_char, console_fill_foreground,
+                  console_fill_background)
+
+
+class Event:
+    """Input event carrying the attributes main.py reads off tdl events."""
+    def __init__(self, type, key="", char="", text="", control=False,
+                 cell=(0, 0), button=None):
+        self.type = type
+        self.key = key
+        self.char = char
+        self.text = text
+        self.control = control
+        self.cell = cell
+        self.button = button
+
+
+def keydown(key=None, text="", control=False):
+    """Return a scripted KEYDOWN event; key defaults to "CHAR" for text."""
+    if key is None:
+        key = "CHAR" if text else ""
+    return Event("KEYDOWN", key=key, char=text, text=text, control=control)
+
+
+def mousedown(cell, button="LEFT"):
+    """Return a scripted MOUSEDOWN event."""
+    return Event("MOUSEDOWN", cell=cell, button=button)
+
+
+class TdlBackend:
+    """Backend drawing to a real tdl window."""
+    def __init__(self, width, height, title, font, fps):
+        tdl.set_font(font, greyscale=True, altLayout=True)
+        self.root = tdl.init(width, height, title=title, fullscreen=False)
+        tdl.setFPS(fps)
+        self._images = {}
+
+    def new_console(self, width, height):
+        return tdl.Console(width, height)
+
+    def fill(self, console, ch, fg, bg):
+        """Write [x, y] glyph and colour planes to console in one go."""
+        console_fill_char(console, ch.ravel(order="F"))
+        console_fill_foreground(console, *(fg[:, :, i].ravel(order="F")
+                                           for i in range(3)))
+        console_fill_background(console, *(bg[:, :, i].ravel(order="F")
+                                           for i in range(3)))
+
+    def blit_image(self, path):
+        """Draw image at double resolution over the root console."""
+        if path not in self._images:
+            self._images[path] = image_load(path)
+        self._images[path].blit_2x(self.root, 0, 0)
+
+    def flush(self):
+        tdl.flush()
+
+    def get_events(self):
+        return tdl.event.get()
+
+    def wait_event(self):
+        """Wait for the next input event and return it.
+
+        tdl polls for it with a 1 ms sleep in between, so waiting is cheap
+        but not free.
+        """
+        # Without a timeout, as tdl's timeout relies on time.clock().
+        return tdl.event.wait(flush=False)
+
+    def wait_key(self):
+        return tdl.event.key_wait()
+
+    def is_closed(self):
+        return tdl.event.is_window_closed()
+
+    def toggle_fullscreen(self):
+        tdl.set_fullscreen(not tdl.get_fullscreen())
+
+
+class NullConsole:
+    """Console that accepts drawing calls and discards them."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def draw_char(self, x, y, char, fg=Ellipsis, bg=Ellipsis):
+        pass
+
+    def draw_str(self, x, y, string, fg=Ellipsis, bg=Ellipsis):
+        pass
+
+    def draw_rect(self, x, y, width, height, string, fg=Ellipsis,
+                  bg=Ellipsis):
+        pass
+
+    def clear(self, fg=Ellipsis, bg=Ellipsis):
+        pass
+
+    def blit(self, source, x=0, y=0, width=None, height=None, srcX=0,
+             srcY=0):
+        pass
+
+
+class NullBackend:
+    """Backend with no display, reading input from a scripted source.
+
+    events is any iterable of Event; each poll consumes one, so one key is
+    handled per turn. polls may be given instead, an iterable of lists of
+    Event handed out one list per poll, e.g. as recorded by replay.py. Once
+    the input runs out the "window" reports itself closed.
+    """
+    def __init__(self, width, height, events=(), polls=None):
+        self.root = NullConsole(width, height)
+        if polls is None:
+            polls = ([event] for event in events)
+        self._polls = iter(polls)
+        # Rest of a poll partly taken by wait_event or wait_key.
+        self._pending = []
+        self._closed = False
+
+    def new_console(self, width, height):
+        return NullConsole(width, height)
+
+    def fill(self, console, ch, fg, bg):
+        pass
+
+    def blit_image(self, path):
+        pass
+
+    def flush(self):
+        pass
+
+    def _next_poll(self):
+        if self._pending:
+            poll = self._pending
+            self._pending = []
+            return poll
+        if self._closed:
+            return None
+        poll = next(self._polls, None)
+        if poll is None:
+            self._closed = True
+        return poll
+
+    def get_events(self):
+        poll = self._next_poll()
+        return [] if poll is None else list(poll)
+
+    def wait_event(self):
+        """Return the next event, or None once input has run out."""
+        while not self._pending:
+            poll = self._next_poll()
+            if poll is None:
+                return None
+            self._pending = list(poll)
+        return self._pending.pop(0)
+
+    def wait_key(self):
+        while True:
+            event = self.wait_event()
+            if event is None:
+                return keydown("ESCAPE")
+            if event.type == "KEYDOWN":
+                return event
+
+    def is_closed(self):
+        return self._closed
+
+    def toggle_fullscreen(self):
+        pass
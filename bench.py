@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Benchmarks for the hot paths of Umbrella Rogue.
+
+Times map generation, the FOV step (afresh and from cache), a full-map
+redraw, a round of monster turns, message throughput and saving/loading.
+Every case runs headless over map sizes and monster densities scaled up from
+settings.py.
+
+    python3 bench.py                             # print a table
+    python3 bench.py --json bench_output.json    # also write results
+    python3 bench.py --baseline old.json         # compare; exit 1 if slower
+    python3 bench.py --replay game.json          # also time a recorded game
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import settings
+import main
+from backends import NullBackend
+
+# Map sides and monsters per room are multiplied by these.
+MAP_SCALES = (1, 2, 4)
+DENSITY_SCALES = (1, 2, 4)
+MESSAGES_PER_RUN = 100
+
+
+def timed(func, repeat):
+    """Return list of wall times of repeat calls to func."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def setup_game(width, height, rooms, room_monsters, seed):
+    """Start a headless game on a map of the given size and density."""
+    main.MAP_WIDTH = width
+    main.MAP_HEIGHT = height
+    settings.max_rooms = rooms
+    settings.max_room_monsters = room_monsters
+    main.init_backend(NullBackend(main.SCREEN_WIDTH, main.SCREEN_HEIGHT))
+    main.new_game(seed=seed)
+    # Keep the player alive however many monsters pile on.
+    main.player.fighter.max_hp = main.player.fighter.hp = 10 ** 9
+    main.init_render_state()
+    main.render_all()
+
+
+def fov():
+    # Compute it afresh rather than time a cache hit; fov_cached does that.
+    main.my_map.fov_cache.clear()
+    main.update_fov()
+
+
+def full_redraw():
+    main.mark_all_dirty()
+    main.render_all()
+
+
+def message_burst():
+    for i in range(MESSAGES_PER_RUN):
+        main.message("The orc attacks player for 3 hp.", main.colors.flame)
+
+
+def save_size(path):
+    """Return total size of the files making up the save at path."""
+    folder, base = os.path.split(path)
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for name in os.listdir(folder) if name.startswith(base))
+
+
+def run_replay(path, repeat):
+    """Time replaying the recording at path; return a result dict."""
+    turns = []
+    times = timed(lambda: turns.append(main.run_replay(path)), repeat)
+    return {"case": "replay:" + os.path.basename(path),
+            "map_width": main.MAP_WIDTH,
+            "map_height": main.MAP_HEIGHT,
+            "rooms": settings.max_rooms,
+            "room_monsters": settings.max_room_monsters,
+            "objects": len(main.objects),
+            "turns": turns[-1],
+            "repeat": repeat,
+            "min": min(times),
+            "median": statistics.median(times)}
+
+
+def run_size(scale, density, repeat, folder, seed):
+    """Run every case for one map size and density; return result dicts."""
+    width = settings.map_width * scale
+    height = settings.map_height * scale
+    rooms = settings.max_rooms * scale * scale
+    room_monsters = settings.max_room_monsters * density
+    setup_game(width, height, rooms, room_monsters, seed)
+    path = os.path.join(folder, "bench")
+
+    cases = [("make_map", main.make_map),
+             ("fov", fov),
+             ("fov_cached", main.update_fov),
+             ("full_redraw", full_redraw),
+             ("monster_round", main.take_monster_turns),
+             ("message", message_burst),
+             ("save_game", lambda: main.save_game(path)),
+             ("load_game", lambda: main.load_game(path))]
+    results = []
+    for name, func in cases:
+        times = timed(func, repeat)
+        result = {"case": name,
+                  "map_width": width,
+                  "map_height": height,
+                  "rooms": rooms,
+                  "room_monsters": room_monsters,
+                  "objects": len(main.objects),
+                  "repeat": repeat,
+                  "min": min(times),
+                  "median": statistics.median(times)}
+        if name == "save_game":
+            result["bytes"] = save_size(path)
+        results.append(result)
+        if name == "make_map":
+            # Redraw state must match the freshly generated map.
+            main.init_render_state()
+            main.render_all()
+    return results
+
+
+def case_key(result):
+    return (result["case"], result["map_width"], result["map_height"],
+            result["room_monsters"])
+
+
+def compare(results, baseline, threshold):
+    """Print change against baseline; return number of regressions."""
+    old = {case_key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        before = old.get(case_key(result))
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{:<14} {:>4}x{:<4} m{:<3} {:>10.6f} -> {:>10.6f} "
+              "x{:.2f}{}".format(result["case"], result["map_width"],
+                                 result["map_height"],
+                                 result["room_monsters"], before["median"],
+                                 result["median"], ratio, flag))
+    return regressions
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scales", type=int, nargs="+", default=MAP_SCALES)
+    parser.add_argument("--densities", type=int, nargs="+",
+                        default=DENSITY_SCALES)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown before flagging, as a "
+                             "fraction (default 0.10)")
+    parser.add_argument("--generator", choices=sorted(main.ROOM_GENERATORS),
+                        default=settings.dungeon_generator,
+                        help="room placement to benchmark make_map with")
+    parser.add_argument("--replay", nargs="+", default=[], metavar="FILE",
+                        help="recorded games (main.py --record) to time")
+    args = parser.parse_args()
+
+    results = []
+    settings.dungeon_generator = args.generator
+    # Replays first, while map size and density are still as recorded.
+    for path in args.replay:
+        result = run_replay(path, args.repeat)
+        results.append(result)
+        print("{:<28} turns {:<6} median {:.6f}s".format(
+            result["case"], result["turns"], result["median"]))
+    with tempfile.TemporaryDirectory() as folder:
+        for scale in args.scales:
+            for density in args.densities:
+                for result in run_size(scale, density, args.repeat, folder,
+                                       args.seed):
+                    results.append(result)
+                    print("{:<14} {:>4}x{:<4} m{:<3} objs {:<6} "
+                          "median {:.6f}s".format(result["case"],
+                                                  result["map_width"],
+                                                  result["map_height"],
+                                                  result["room_monsters"],
+                                                  result["objects"],
+                                                  result["median"]))
+
+    report = {"python": platform.python_version(),
+              "machine": platform.machine(),
+              "seed": args.seed,
+              "generator": args.generator,
+              "results": results}
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_bench()
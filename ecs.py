@@ -0,0 +1,179 @@
+"""Entity storage for Umbrella Rogue.
+
+Entities are rows of an EntityStore. Numeric state (position, glyph and
+colour, fighter stats, speed, AI kind and state) lives in dense numpy arrays
+indexed by entity id, struct-of-arrays style, and the few Python values
+(names, callbacks) in parallel lists. Ids of removed entities go on a free
+list to be reused, so the arrays stay dense.
+
+GameObject and its components in main.py are handles onto a row: they hold
+a store and an id, or an owner, and read and write the arrays through
+Column and Flag descriptors. An entity's state then costs a row of about
+eighty bytes instead of a handful of objects and dicts, and systems can
+work on many entities at once by indexing the arrays with an array of ids.
+"""
+import numpy as np
+
+# Bits of the flags column.
+BLOCKS = 1
+FIGHTER = 2
+ITEM = 4
+
+# Numeric columns and their dtypes; fg is (capacity, 3) RGB.
+NUMERIC = {"x": np.int32, "y": np.int32, "char": np.uint32,
+           "flags": np.uint8, "stairs": np.int8,
+           "hp": np.int32, "max_hp": np.int32, "defense": np.int32,
+           "power": np.int32, "ai_kind": np.uint8, "ai_turns": np.int32,
+           "old_ai_kind": np.uint8, "speed": np.int16}
+# Python object columns; handle maps an id back to its GameObject.
+OBJECTS = ("handle", "name", "bg", "death", "use")
+
+
+class EntityStore:
+    """Struct-of-arrays storage for entities, growing as needed."""
+    def __init__(self, capacity=16):
+        self.capacity = 0
+        # Ids below size have been handed out at least once.
+        self.size = 0
+        self._free = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.fg = np.zeros((0, 3), dtype=np.uint8)
+        for name, dtype in NUMERIC.items():
+            setattr(self, name, np.zeros(0, dtype=dtype))
+        for name in OBJECTS:
+            setattr(self, name, [])
+        self._grow(capacity)
+
+    def __len__(self):
+        return self.size - len(self._free)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        self.alive = np.concatenate([self.alive, np.zeros(extra, bool)])
+        self.fg = np.concatenate([self.fg, np.zeros((extra, 3), np.uint8)])
+        for name in NUMERIC:
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate(
+                [column, np.zeros(extra, dtype=column.dtype)]))
+        for name in OBJECTS:
+            getattr(self, name).extend([None] * extra)
+        self.capacity = capacity
+
+    def create(self, handle):
+        """Return id of a new, zeroed entity whose handle is handle."""
+        if self._free:
+            entity = self._free.pop()
+        else:
+            if self.size == self.capacity:
+                self._grow(max(16, self.capacity * 2))
+            entity = self.size
+            self.size += 1
+        self.alive[entity] = True
+        self.handle[entity] = handle
+        return entity
+
+    def remove(self, entity):
+        """Free the row of entity for reuse."""
+        self.alive[entity] = False
+        self.fg[entity] = 0
+        for name in NUMERIC:
+            getattr(self, name)[entity] = 0
+        for name in OBJECTS:
+            getattr(self, name)[entity] = None
+        self._free.append(entity)
+
+    def move(self, entity, other):
+        """Move entity into store other; return its id there."""
+        new = other.create(self.handle[entity])
+        other.fg[new] = self.fg[entity]
+        for name in NUMERIC:
+            getattr(other, name)[new] = getattr(self, name)[entity]
+        for name in OBJECTS:
+            getattr(other, name)[new] = getattr(self, name)[entity]
+        self.remove(entity)
+        return new
+
+
+class Column:
+    """Descriptor for a handle attribute stored in one store column.
+
+    Handles define row(), returning (store, id), or None while they are not
+    attached to a store yet, in which case values live in handle._spec.
+    get and put convert values on the way out and in.
+    """
+    def __init__(self, column, get=None, put=None):
+        self.column = column
+        self.get = get
+        self.put = put
+
+    def __get__(self, handle, cls=None):
+        if handle is None:
+            return self
+        row = handle.row()
+        if row is None:
+            return handle._spec[self.column]
+        (store, entity) = row
+        value = getattr(store, self.column)[entity]
+        return value if self.get is None else self.get(value)
+
+    def __set__(self, handle, value):
+        row = handle.row()
+        if row is None:
+            handle._spec[self.column] = value
+            return
+        (store, entity) = row
+        getattr(store, self.column)[entity] = (value if self.put is None
+                                               else self.put(value))
+
+
+class Flag:
+    """Descriptor for a boolean handle attribute kept in the flags column."""
+    def __init__(self, bit):
+        self.bit = bit
+
+    def __get__(self, handle, cls=None):
+        if handle is None:
+            return self
+        (store, entity) = handle.row()
+        return bool(store.flags[entity] & self.bit)
+
+    def __set__(self, handle, value):
+        (store, entity) = handle.row()
+        if value:
+            store.flags[entity] |= self.bit
+        else:
+            store.flags[entity] &= ~np.uint8(self.bit)
+
+
+class Component:
+    """Base for component handles, such as main.Fighter.
+
+    Made on its own, a component keeps its values until attach() copies
+    them into a GameObject's row; bound() returns a view of that row.
+    Subclasses declare their Column attributes in fields.
+    """
+    __slots__ = ("owner", "_spec")
+    fields = ()
+
+    def __init__(self):
+        self.owner = None
+        self._spec = {}
+
+    @classmethod
+    def bound(cls, owner):
+        """Return view of this component in the row of GameObject owner."""
+        view = cls.__new__(cls)
+        view.owner = owner
+        view._spec = None
+        return view
+
+    def row(self):
+        return None if self.owner is None else self.owner.row()
+
+    def attach(self, owner):
+        """Copy this component's values into the row of owner; return view."""
+        values = [getattr(self, name) for name in self.fields]
+        view = self.bound(owner)
+        for name, value in zip(self.fields, values):
+            setattr(view, name, value)
+        return view
@@ -0,0 +1,394 @@
+"""Tile map for Umbrella Rogue.
+
+Tiles are stored as one contiguous boolean array per property instead of a
+grid of Tile objects. Arrays are indexed [x, y], the same way the old
+my_map[x][y] lists were, and kept in Fortran order so a column of the map is
+contiguous in memory.
+
+Field of view is computed natively by libtcod from a transparency map that
+is only rebuilt when the tiles change, so no Python callback is made per
+probed cell. Results are kept as Window masks in a small LRU keyed by the
+viewpoint, the FOV options and the map version, so stepping back and forth
+or returning to a spot reuses them; any change to the tiles bumps the
+version and empties the cache.
+
+ChunkedMap has the same interface for maps too big to hold in memory: tiles
+live in fixed-size chunks that are generated or loaded on first use, kept in
+an LRU and written back to a memory-mapped file when evicted.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import tdl
+
+
+def fov_bounds(width, height, x, y, radius):
+    """Return (x0, y0, x1, y1) of the map area an FOV radius can reach."""
+    if radius is None:
+        return (0, 0, width, height)
+    return (max(0, x - radius), max(0, y - radius),
+            min(width, x + radius + 1), min(height, y + radius + 1))
+
+
+class Window:
+    """Boolean mask over the map area x0 <= x < x1, y0 <= y < y1.
+
+    Indexed with map coords like a full-size array, scalars or integer
+    arrays; anything outside the window reads as False. Used for FOV, so
+    its size depends on the view radius rather than on the map.
+    """
+    def __init__(self, x0, y0, mask):
+        self.x0 = x0
+        self.y0 = y0
+        self.mask = mask
+        self.x1 = x0 + mask.shape[0]
+        self.y1 = y0 + mask.shape[1]
+
+    @classmethod
+    def empty(cls):
+        return cls(0, 0, np.zeros((0, 0), dtype=bool, order="F"))
+
+    def __getitem__(self, key):
+        (x, y) = key
+        if isinstance(x, int) and isinstance(y, int):
+            x -= self.x0
+            y -= self.y0
+            return (0 <= x < self.mask.shape[0] and
+                    0 <= y < self.mask.shape[1] and bool(self.mask[x, y]))
+        x = np.asarray(x) - self.x0
+        y = np.asarray(y) - self.y0
+        (width, height) = self.mask.shape
+        if not self.mask.size:
+            result = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+            return result if result.ndim else bool(result)
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        result = inside & self.mask[np.where(inside, x, 0),
+                                    np.where(inside, y, 0)]
+        return result if result.ndim else bool(result)
+
+    def slices(self):
+        """Return the (x, y) slices of the map the window covers."""
+        return (slice(self.x0, self.x1), slice(self.y0, self.y1))
+
+    def cells(self):
+        """Return set of map coords that are True."""
+        xs, ys = self.mask.nonzero()
+        return set(zip((xs + self.x0).tolist(), (ys + self.y0).tolist()))
+
+    def changed(self, other):
+        """Return set of map coords where this window and other differ."""
+        # Windows far apart, e.g. after a teleport, share no cells.
+        if (self.x1 <= other.x0 or other.x1 <= self.x0 or
+                self.y1 <= other.y0 or other.y1 <= self.y0):
+            return self.cells() | other.cells()
+        x0, y0 = min(self.x0, other.x0), min(self.y0, other.y0)
+        x1, y1 = max(self.x1, other.x1), max(self.y1, other.y1)
+        xs, ys = (self.crop(x0, y0, x1, y1) ^
+                  other.crop(x0, y0, x1, y1)).nonzero()
+        return set(zip((xs + x0).tolist(), (ys + y0).tolist()))
+
+    def crop(self, x0, y0, x1, y1):
+        """Return the mask over map area x0:x1, y0:y1 as a new array."""
+        out = np.zeros((x1 - x0, y1 - y0), dtype=bool, order="F")
+        left, top = max(x0, self.x0), max(y0, self.y0)
+        right, bottom = min(x1, self.x1), min(y1, self.y1)
+        if left < right and top < bottom:
+            out[left - x0:right - x0, top - y0:bottom - y0] = \
+                self.mask[left - self.x0:right - self.x0,
+                          top - self.y0:bottom - self.y0]
+        return out
+
+
+class FovCache:
+    """LRU of FOV Windows for one map version.
+
+    Keys are (x, y, fov, radius, light_walls). Looking up a version other
+    than the one stored drops everything, as the tiles have changed since.
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.version = None
+        self._windows = OrderedDict()
+
+    def __len__(self):
+        return len(self._windows)
+
+    def clear(self):
+        """Forget every stored Window."""
+        self._windows.clear()
+
+    def get(self, version, key):
+        """Return the Window stored for key at version, or None."""
+        if version != self.version:
+            self._windows.clear()
+            self.version = version
+            return None
+        window = self._windows.get(key)
+        if window is not None:
+            self._windows.move_to_end(key)
+        return window
+
+    def put(self, version, key, window):
+        """Store window for key at version, dropping the least recent."""
+        if version != self.version or not self.capacity:
+            return
+        self._windows[key] = window
+        while len(self._windows) > self.capacity:
+            self._windows.popitem(last=False)
+
+
+class GameMap:
+    """Map of tiles, held as boolean arrays."""
+    def __init__(self, width, height, fov_cache_size=64):
+        self.width = width
+        self.height = height
+        # Everything starts as solid rock; rooms and tunnels are carved out.
+        self.blocked = np.ones((width, height), dtype=bool, order="F")
+        self.block_sight = np.ones((width, height), dtype=bool, order="F")
+        self.explored = np.zeros((width, height), dtype=bool, order="F")
+        # Bumped whenever blocked or block_sight change.
+        self.version = 0
+        self._fov_map = None
+        self._fov_version = None
+        self.fov_cache = FovCache(fov_cache_size)
+
+    def carve(self, x1, y1, x2, y2):
+        """Turn the tiles x1 <= x < x2, y1 <= y < y2 into floor."""
+        self.blocked[x1:x2, y1:y2] = False
+        self.block_sight[x1:x2, y1:y2] = False
+        self.version += 1
+
+    def transparent(self):
+        """Return array of tiles that can be seen through."""
+        return ~(self.blocked | self.block_sight)
+
+    def compute_fov(self, x, y, fov="BASIC", radius=None, light_walls=True):
+        """Return Window of tiles visible from coords.
+
+        The Window may be shared with later calls, so must not be changed.
+        """
+        key = (x, y, fov, radius, light_walls)
+        window = self.fov_cache.get(self.version, key)
+        if window is not None:
+            return window
+        if self._fov_map is None:
+            self._fov_map = tdl.map.Map(self.width, self.height)
+        if self._fov_version != self.version:
+            self._fov_map.transparent[:] = self.transparent()
+            self._fov_version = self.version
+        self._fov_map.compute_fov(x, y, fov=fov, radius=radius,
+                                  light_walls=light_walls)
+        (x0, y0, x1, y1) = fov_bounds(self.width, self.height, x, y, radius)
+        window = Window(x0, y0, self._fov_map.fov[x0:x1, y0:y1].copy())
+        self.fov_cache.put(self.version, key, window)
+        return window
+
+    def known_area(self, x0, y0, x1, y1):
+        """Return (block_sight, explored) arrays over x0:x1, y0:y1."""
+        return (self.block_sight[x0:x1, y0:y1].copy(),
+                self.explored[x0:x1, y0:y1].copy())
+
+    def flush(self):
+        """Nothing to write; GameMap lives entirely in memory."""
+
+
+# ChunkedMap tile bits.
+BLOCKED = 1
+BLOCK_SIGHT = 2
+EXPLORED = 4
+
+
+class ChunkedLayer:
+    """One tile property of a ChunkedMap, indexed like a GameMap array.
+
+    Supports [x, y] with integers or slices (step 1); slices read back a new
+    array and write through to the chunks they cover.
+    """
+    def __init__(self, world, bit):
+        self._world = world
+        self._bit = bit
+        self.shape = (world.width, world.height)
+
+    def __getitem__(self, key):
+        area = self._world.read(*key)
+        return bool(area & self._bit) if np.isscalar(area) else \
+            (area & self._bit).astype(bool)
+
+    def __setitem__(self, key, value):
+        self._world.write(self._bit, value, *key)
+
+    def copy(self):
+        """Return the whole layer as an array, loading every chunk."""
+        return self[:, :]
+
+
+class ChunkedMap:
+    """Map of tiles stored in chunk_size square chunks, loaded on demand.
+
+    Has the GameMap interface. generate(cx, cy, width, height) returns the
+    uint8 tile bits (BLOCKED, BLOCK_SIGHT, EXPLORED) of a chunk the first
+    time it is touched; after that it is read back from the file at path.
+    At most capacity chunks are held in memory, least recently used going
+    back to the file first.
+    An existing file at path is reopened rather than overwritten, if its
+    size fits the map and chunk size.
+    """
+    def __init__(self, width, height, path, generate, chunk_size=64,
+                 capacity=64, fov_cache_size=64):
+        self.width = width
+        self.height = height
+        self.path = path
+        self.chunk_size = chunk_size
+        self.capacity = capacity
+        self._generate = generate
+        self.chunks_x = -(-width // chunk_size)
+        self.chunks_y = -(-height // chunk_size)
+        tile_bytes = self.chunks_x * self.chunks_y * chunk_size * chunk_size
+        size = tile_bytes + self.chunks_x * self.chunks_y
+        # A file made for another map size or chunk size is started over.
+        reopen = os.path.exists(path) and os.path.getsize(path) == size
+        self._file = np.memmap(path, dtype=np.uint8,
+                               mode="r+" if reopen else "w+", shape=(size,))
+        # Chunk-major, so each chunk is one contiguous run of the file.
+        self._stored = self._file[:tile_bytes].reshape(
+            (self.chunks_x, self.chunks_y, chunk_size, chunk_size))
+        self._present = self._file[tile_bytes:].reshape(
+            (self.chunks_x, self.chunks_y))
+        self._resident = OrderedDict()
+        self._dirty = set()
+        self.version = 0
+        self.fov_cache = FovCache(fov_cache_size)
+        self.blocked = ChunkedLayer(self, BLOCKED)
+        self.block_sight = ChunkedLayer(self, BLOCK_SIGHT)
+        self.explored = ChunkedLayer(self, EXPLORED)
+
+    def chunk(self, cx, cy):
+        """Return the tile array of chunk (cx, cy), loading it if needed."""
+        key = (cx, cy)
+        tiles = self._resident.get(key)
+        if tiles is not None:
+            self._resident.move_to_end(key)
+            return tiles
+        if self._present[cx, cy]:
+            tiles = np.array(self._stored[cx, cy], order="F")
+        else:
+            size = self.chunk_size
+            tiles = np.full((size, size), BLOCKED | BLOCK_SIGHT,
+                            dtype=np.uint8, order="F")
+            width = min(size, self.width - cx * size)
+            height = min(size, self.height - cy * size)
+            tiles[:width, :height] = self._generate(cx, cy, width, height)
+            self._dirty.add(key)
+        self._resident[key] = tiles
+        while len(self._resident) > self.capacity:
+            self._evict(*self._resident.popitem(last=False))
+        return tiles
+
+    def _evict(self, key, tiles):
+        if key in self._dirty:
+            self._stored[key] = tiles
+            self._present[key] = 1
+            self._dirty.discard(key)
+
+    def _areas(self, x, y):
+        """Yield (tiles, chunk slices, result slices) covering x, y."""
+        size = self.chunk_size
+        for cx in range(x.start // size, -(-x.stop // size)):
+            left = max(x.start, cx * size)
+            right = min(x.stop, (cx + 1) * size)
+            for cy in range(y.start // size, -(-y.stop // size)):
+                top = max(y.start, cy * size)
+                bottom = min(y.stop, (cy + 1) * size)
+                yield ((cx, cy),
+                       (slice(left - cx * size, right - cx * size),
+                        slice(top - cy * size, bottom - cy * size)),
+                       (slice(left - x.start, right - x.start),
+                        slice(top - y.start, bottom - y.start)))
+
+    def _span(self, index, size):
+        if isinstance(index, slice):
+            return slice(*index.indices(size)[:2])
+        return slice(index, index + 1)
+
+    def read(self, x, y, generate=True):
+        """Return the tile bits at x, y (integers or slices).
+
+        With generate False, chunks never made read as unexplored rock
+        instead of being made.
+        """
+        if not isinstance(x, slice) and not isinstance(y, slice):
+            size = self.chunk_size
+            return self.chunk(x // size, y // size)[x % size, y % size]
+        xs = self._span(x, self.width)
+        ys = self._span(y, self.height)
+        out = np.zeros((max(0, xs.stop - xs.start),
+                        max(0, ys.stop - ys.start)),
+                       dtype=np.uint8, order="F")
+        for key, inner, outer in self._areas(xs, ys):
+            if generate or key in self._resident or self._present[key]:
+                out[outer] = self.chunk(*key)[inner]
+            else:
+                out[outer] = BLOCKED | BLOCK_SIGHT
+        if not isinstance(x, slice):
+            return out[0]
+        if not isinstance(y, slice):
+            return out[:, 0]
+        return out
+
+    def write(self, bit, value, x, y):
+        """Set (value True) or clear bit over x, y (integers or slices)."""
+        xs = self._span(x, self.width)
+        ys = self._span(y, self.height)
+        value = np.asarray(value, dtype=bool)
+        if value.ndim == 1:
+            value = value.reshape((xs.stop - xs.start, ys.stop - ys.start))
+        for key, inner, outer in self._areas(xs, ys):
+            tiles = self.chunk(*key)
+            part = value[outer] if value.ndim else value
+            tiles[inner] = np.where(part, tiles[inner] | bit,
+                                    tiles[inner] & ~np.uint8(bit))
+            self._dirty.add(key)
+
+    def carve(self, x1, y1, x2, y2):
+        """Turn the tiles x1 <= x < x2, y1 <= y < y2 into floor."""
+        self.blocked[x1:x2, y1:y2] = False
+        self.block_sight[x1:x2, y1:y2] = False
+        self.version += 1
+
+    def known_area(self, x0, y0, x1, y1):
+        """Return (block_sight, explored) arrays over x0:x1, y0:y1.
+
+        Chunks not made yet are left that way; they are all unexplored.
+        """
+        tiles = self.read(slice(x0, x1), slice(y0, y1), generate=False)
+        return ((tiles & BLOCK_SIGHT).astype(bool),
+                (tiles & EXPLORED).astype(bool))
+
+    def compute_fov(self, x, y, fov="BASIC", radius=None, light_walls=True):
+        """Return Window of tiles visible from coords.
+
+        Only the square radius reaches is loaded, so radius is required.
+        The Window may be shared with later calls, so must not be changed.
+        """
+        if radius is None:
+            raise ValueError("ChunkedMap needs an FOV radius.")
+        key = (x, y, fov, radius, light_walls)
+        window = self.fov_cache.get(self.version, key)
+        if window is not None:
+            return window
+        (x0, y0, x1, y1) = fov_bounds(self.width, self.height, x, y, radius)
+        tiles = self.read(slice(x0, x1), slice(y0, y1))
+        fov_map = tdl.map.Map(x1 - x0, y1 - y0)
+        fov_map.transparent[:] = (tiles & (BLOCKED | BLOCK_SIGHT)) == 0
+        fov_map.compute_fov(x - x0, y - y0, fov=fov, radius=radius,
+                            light_walls=light_walls)
+        window = Window(x0, y0, fov_map.fov.copy())
+        self.fov_cache.put(self.version, key, window)
+        return window
+
+    def flush(self):
+        """Write every changed chunk back to the file."""
+        for key in list(self._dirty):
+            self._evict(key, self._resident[key])
+        self._file.flush()
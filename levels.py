@@ -0,0 +1,198 @@
+"""Dungeon levels for Umbrella Rogue.
+
+A Level is one floor: its map and the objects lying on it. Visited levels
+live in a LevelCache, which keeps the most recently used ones in memory and
+compresses the rest out to disk. A Pregenerator builds the next level down
+on a worker thread while the player is still busy on the current one, so
+taking the stairs does not wait on map generation.
+"""
+import os
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import savefile
+from activity import ActiveSet
+from ecs import EntityStore
+from spatial import SpatialIndex
+
+
+class Level:
+    """One dungeon floor: its map and the objects on it.
+
+    The objects' state lives in store, so a level and everything on it is
+    dropped together when it is evicted.
+    """
+    def __init__(self, depth, game_map, start):
+        self.depth = depth
+        self.game_map = game_map
+        self.store = EntityStore()
+        self.objects = []
+        self.object_index = SpatialIndex()
+        # Monsters near enough to the player to take turns.
+        self.active = ActiveSet()
+        # Where the player arrives from above, and where each staircase is.
+        self.start = start
+        self.stairs = {}
+        # Rooms of chunks made since objects were last placed, for levels
+        # on a gamemap.ChunkedMap.
+        self.unpopulated = []
+
+    def add(self, obj, back=False):
+        """Put obj on the level; back draws it under everything else."""
+        if back:
+            self.objects.insert(0, obj)
+        else:
+            self.objects.append(obj)
+        self.object_index.add(obj)
+
+    def is_blocked(self, x, y):
+        """Tests if given coords are blocked/blocking on this level."""
+        if self.game_map.blocked[x, y]:
+            return True
+        return self.object_index.blocking_at(x, y) is not None
+
+
+class LevelCache:
+    """Visited levels by depth.
+
+    Up to capacity levels are kept in memory, least recently used evicted
+    first. Evicted levels are copied out with snapshot, which returns the
+    arguments of savefile.dumps, then turned into bytes, zlib-compressed
+    and written next to the save as "<prefix>.level-<depth>.z", or kept
+    compressed in memory if prefix is None. decode turns the bytes back into
+    a Level.
+
+    For autosaves, snapshot_changed() copies the changed levels on the main
+    thread and write() does the slow part on another.
+    """
+    def __init__(self, capacity, snapshot, decode, prefix=None):
+        self.capacity = capacity
+        self._snapshot = snapshot
+        self._decode = decode
+        self._prefix = prefix
+        self._resident = OrderedDict()
+        self._stored = {}
+        self._dirty = set()
+        # Depths snapshotted for write() but not yet written.
+        self._pending = set()
+
+    def _path(self, depth):
+        return "{}.level-{}.z".format(self._prefix, depth)
+
+    def __contains__(self, depth):
+        if depth in self._resident or depth in self._stored:
+            return True
+        return self._prefix is not None and os.path.exists(self._path(depth))
+
+    def put(self, level):
+        """Store level, evicting old levels if over capacity."""
+        self._resident[level.depth] = level
+        self._resident.move_to_end(level.depth)
+        self._dirty.add(level.depth)
+        while len(self._resident) > self.capacity:
+            depth, old = self._resident.popitem(last=False)
+            if depth in self._dirty or depth in self._pending:
+                self._store(old)
+
+    def take(self, depth):
+        """Remove level at depth from the cache and return it."""
+        level = self._resident.pop(depth, None)
+        if level is not None:
+            return level
+        if self._prefix is None:
+            data = self._stored[depth]
+        else:
+            with open(self._path(depth), "rb") as f:
+                data = f.read()
+        return self._decode(zlib.decompress(data))
+
+    def flush(self):
+        """Write out every level changed since it was last stored."""
+        for depth, level in self._resident.items():
+            if depth in self._dirty or depth in self._pending:
+                self._store(level)
+
+    def snapshot_changed(self):
+        """Return list of (depth, snapshot) of the levels changed since
+        they were last stored, to hand to write().
+        """
+        snapshots = [(depth, self._snapshot(level))
+                     for depth, level in self._resident.items()
+                     if depth in self._dirty]
+        for depth, snapshot in snapshots:
+            self._dirty.discard(depth)
+            self._pending.add(depth)
+        return snapshots
+
+    def write(self, snapshots):
+        """Store snapshots from snapshot_changed(); safe on another thread.
+
+        Until it has finished, the levels are stored again if evicted or
+        flushed.
+        """
+        for depth, snapshot in snapshots:
+            self._write(depth, snapshot)
+            self._pending.discard(depth)
+
+    def clear(self):
+        """Forget every level, deleting any files written for them."""
+        if self._prefix is not None:
+            folder, base = os.path.split(self._prefix)
+            folder = folder or "."
+            names = os.listdir(folder) if os.path.isdir(folder) else []
+            for name in names:
+                if name.startswith(base + ".level-"):
+                    os.remove(os.path.join(folder, name))
+        self._resident.clear()
+        self._stored.clear()
+        self._dirty.clear()
+        self._pending.clear()
+
+    def _store(self, level):
+        self._write(level.depth, self._snapshot(level))
+        self._dirty.discard(level.depth)
+        self._pending.discard(level.depth)
+
+    def _write(self, depth, snapshot):
+        data = zlib.compress(savefile.dumps(*snapshot))
+        if self._prefix is None:
+            self._stored[depth] = data
+        else:
+            savefile.write_bytes(self._path(depth), data)
+
+
+class Pregenerator:
+    """Generates levels ahead of time on a worker thread.
+
+    generate(depth) must not touch game state outside the Level it returns.
+    """
+    def __init__(self, generate):
+        self._generate = generate
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}
+
+    def request(self, depth):
+        """Start generating level depth in the background."""
+        if depth not in self._pending:
+            self._pending[depth] = self._executor.submit(self._generate,
+                                                         depth)
+
+    def take(self, depth):
+        """Return level depth, waiting for it or generating it here."""
+        future = self._pending.pop(depth, None)
+        if future is None:
+            return self._generate(depth)
+        return future.result()
+
+    def cancel(self):
+        """Drop every level not yet taken.
+
+        Waits for a level already being generated, so it is not still
+        writing files once this returns.
+        """
+        futures = list(self._pending.values())
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        self._pending.clear()
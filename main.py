@@ -1,28 +1,56 @@
 #!/usr/bin/env python3
-import tdl
-from random import randint
+import argparse
+import os
+import tempfile
+import textwrap
+import numpy as np
 import colors
+import ecs
 import math
-import textwrap
 import settings
-from tcod import image_load
-import shelve
+from gamemap import GameMap, ChunkedMap, Window, BLOCKED, BLOCK_SIGHT
+from spatial import SpatialIndex
+from pathing import FlowField
+from levels import Level, LevelCache, Pregenerator
+from messages import MessageLog
+from backends import TdlBackend, NullBackend
+from rng import RandomStreams, new_seed
+from profiler import Profiler, WAIT
+from scheduler import Scheduler, TURN, NORMAL_SPEED, delay
+import replay
+import savefile
 import time
+from collections import Counter, deque
 
 # GUI/Window settings.
 SCREEN_WIDTH = settings.screen_width
 SCREEN_HEIGHT = settings.screen_height
 MAP_WIDTH = settings.map_width
 MAP_HEIGHT = settings.map_height
-REALTIME = False
+REALTIME = settings.realtime
 LIMIT_FPS = settings.fps
+TICK_RATE = settings.tick_rate
+MAX_FRAME_SKIP = settings.max_frame_skip
 BAR_WIDTH = settings.bar_width
 PANEL_HEIGHT = settings.panel_height
 INVENTORY_WIDTH = settings.inventory_width
 PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
+# The camera shows this much of the map, above the panel.
+VIEW_WIDTH = SCREEN_WIDTH
+VIEW_HEIGHT = PANEL_Y
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
+SAVE_PATH = "savegame/savegame.sav"
+# Chunked worlds only search this far from the player for paths.
+FLOW_RADIUS = settings.flow_radius if settings.world == "chunked" else None
+# Monsters further than this from the player lie dormant. Never less than
+# the corners of the torch's square of view, so whatever is seen is awake.
+WAKE_RADIUS = max(settings.wake_radius, settings.torch_radius * 1.42)
+# Monsters look for paths to the player this far from the player; only
+# those within WAKE_RADIUS act, so flat maps need search no further.
+CHASE_RADIUS = (FLOW_RADIUS if FLOW_RADIUS is not None
+                else math.ceil(WAKE_RADIUS))
 
 
 # Tile Colours.
@@ -30,16 +58,12 @@ color_dark_wall = (0, 0, 100)
 color_light_wall = (130, 110, 50)
 color_dark_ground = (50, 50, 150)
 color_light_ground = (200, 180, 50)
-
-
-class Tile:
-    """Tile on map."""
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
-        self.explored = False
-        if block_sight is None:
-            block_sight = blocked
-        self.block_sight = block_sight
+# Background of each tile, indexed by 2 * visible + wall; 4 is unexplored.
+TILE_PALETTE = np.array([color_dark_ground, color_dark_wall,
+                         color_light_ground, color_light_wall,
+                         colors.black], dtype=np.intc)
+# Above this many dirty cells a bulk redraw is cheaper than cell by cell.
+BULK_REDRAW_CELLS = VIEW_WIDTH * VIEW_HEIGHT // 8
 
 
 class Rect:
@@ -56,16 +80,31 @@ class Rect:
         center_y = (self.y1 + self.y2) // 2
         return (center_x, center_y)
 
-    def intersect(self, other):
-        """Returns True if self intersects with other."""
-        return (self.x1 <= other.x2 and self.x2 >= other.x1 and
-                self.y1 <= other.y2 and self.y2 >= other.y1)
-
 
 class GameObject:
-    """Generic Object."""
+    """Generic Object.
+
+    A handle onto a row of an ecs.EntityStore, entities by default; every
+    attribute but the inventory and spawn point lives in the store.
+    """
+    __slots__ = ("store", "id", "inventory", "spawnx", "spawny")
+    x = ecs.Column("x", int)
+    y = ecs.Column("y", int)
+    char = ecs.Column("char", chr, ord)
+    fg = ecs.Column("fg", tuple)
+    bg = ecs.Column("bg")
+    name = ecs.Column("name")
+    blocks = ecs.Flag(ecs.BLOCKS)
+    # 1 for stairs down, -1 for stairs up.
+    stairs = ecs.Column("stairs", int)
+    # Actions per turn, times NORMAL_SPEED.
+    speed = ecs.Column("speed", int)
+
     def __init__(self, x, y, char, name, fg, bg=None, blocks=False,
-                 fighter=None, ai=None, item=None):
+                 fighter=None, ai=None, item=None, stairs=0,
+                 speed=NORMAL_SPEED, store=None):
+        self.store = entities if store is None else store
+        self.id = self.store.create(self)
         self.x = x
         self.y = y
         self.char = char
@@ -73,22 +112,71 @@ class GameObject:
         self.bg = bg
         self.name = name
         self.blocks = blocks
+        self.stairs = stairs
+        self.speed = speed
         # Components.
         self.fighter = fighter
-        if self.fighter:
-            self.fighter.owner = self
         self.ai = ai
-        if self.ai:
-            self.ai.owner = self
         self.item = item
-        if self.item:
-            self.item.owner = self
+
+    def row(self):
+        return (self.store, self.id)
+
+    def _component(self, flag, component):
+        """Attach component and set flag, or clear flag if it is None."""
+        if component is None:
+            self.store.flags[self.id] &= ~np.uint8(flag)
+        else:
+            self.store.flags[self.id] |= flag
+            component.attach(self)
+
+    @property
+    def fighter(self):
+        if self.store.flags[self.id] & ecs.FIGHTER:
+            return Fighter.bound(self)
+        return None
+
+    @fighter.setter
+    def fighter(self, fighter):
+        self._component(ecs.FIGHTER, fighter)
+
+    @property
+    def item(self):
+        if self.store.flags[self.id] & ecs.ITEM:
+            return Item.bound(self)
+        return None
+
+    @item.setter
+    def item(self, item):
+        self._component(ecs.ITEM, item)
+
+    @property
+    def ai(self):
+        kind = self.store.ai_kind[self.id]
+        return AI_KINDS[kind].bound(self) if kind else None
+
+    @ai.setter
+    def ai(self, ai):
+        self.store.ai_kind[self.id] = 0 if ai is None else ai.kind
+        if ai is not None:
+            ai.attach(self)
+
+    def move_to_store(self, store):
+        """Move this object's row into store."""
+        if store is not self.store:
+            self.id = self.store.move(self.id, store)
+            self.store = store
+
+    def destroy(self):
+        """Free this object's row; the handle must not be used after."""
+        self.store.remove(self.id)
 
     def move(self, dx, dy):
         """Move by given amount (if not blocked)."""
         if not is_blocked(self.x + dx, self.y + dy):
             self.x += dx
             self.y += dy
+            object_index.update(self)
 
     def move_towards(self, target_x, target_y):
         """Move towards target."""
@@ -108,16 +196,6 @@ class GameObject:
     def distance(self, x, y):
         return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 
-    def draw(self):
-        """Draw obj on screen."""
-        global visible_tiles
-        if (self.x, self.y) in visible_tiles:
-            con.draw_char(self.x, self.y, self.char, self.fg, bg=None)
-
-    def clear(self):
-        """Clear obj from screen."""
-        con.draw_char(self.x, self.y, " ", self.fg, bg=None)
-
     def send_to_back(self):
         """Stop this object drawing over others."""
         global objects
@@ -125,9 +203,18 @@ class GameObject:
         objects.insert(0, self)
 
 
-class Fighter:
+class Fighter(ecs.Component):
     """Combat Properties for Objects."""
+    __slots__ = ()
+    fields = ("hp", "max_hp", "defense", "power", "death_function")
+    hp = ecs.Column("hp", int)
+    max_hp = ecs.Column("max_hp", int)
+    defense = ecs.Column("defense", int)
+    power = ecs.Column("power", int)
+    death_function = ecs.Column("death")
+
     def __init__(self, hp, defense, power, death_function=None):
+        super().__init__()
         self.max_hp = hp
         self.hp = hp
         self.defense = defense
@@ -138,6 +225,8 @@ class Fighter:
         """Reduce HP by damage dealt."""
         if damage > 0:
             self.hp -= damage
+            if self.owner is player:
+                stats["damage_taken"] += damage
 
             if self.hp <= 0:
                 func = self.death_function
@@ -166,36 +255,75 @@ class Fighter:
             self.hp = self.max_hp
 
 
-class BasicMonster:
-    """Basic Monster AI."""
-    def take_turn(self):
-        monster = self.owner
-        if (monster.x, monster.y) in visible_tiles:
-            if monster.distance_to(player) >= 1.41:
-                monster.move_towards(player.x, player.y)
-            elif player.fighter.hp > 0:
-                monster.fighter.attack(player)
-
+class BasicMonster(ecs.Component):
+    """Basic Monster AI.
+
+    Monsters the player can see chase and attack the player. Their turns
+    are all taken together, by basic_monster_turns.
+    """
+    __slots__ = ()
+    # Value of the store's ai_kind column for this AI.
+    kind = 1
+
+
+class ConfusedMonster(ecs.Component):
+    """AI for a confused monster.
+
+    Only the kind of old_ai is kept, so confusing a confused monster
+    restarts its confusion rather than nesting it. The confusion wears off
+    as a scheduler effect; the store holds the tick it is due.
+    """
+    __slots__ = ()
+    kind = 2
+    fields = ("old_ai", "num_turns")
+    old_ai = ecs.Column("old_ai_kind", lambda kind: AI_KINDS[kind](),
+                        lambda ai: (ai.old_ai.kind
+                                    if isinstance(ai, ConfusedMonster)
+                                    else ai.kind))
+    # Turns left, rounded up.
+    num_turns = ecs.Column("ai_turns",
+                           lambda due: max(0, -((scheduler.time - due) //
+                                                TURN)),
+                           lambda turns: scheduler.time + turns * TURN)
 
-class ConfusedMonster:
-    """AI for a confused monster."""
     def __init__(self, old_ai, num_turns=settings.confuse_no_turns):
+        super().__init__()
         self.old_ai = old_ai
         self.num_turns = num_turns
 
+    def attach(self, owner):
+        view = super().attach(owner)
+        scheduler.add_effect(owner.store.ai_turns[owner.id], view.wear_off)
+        return view
+
     def take_turn(self):
-        if self.num_turns > 0:
-            self.owner.move(randint(-1, 1), randint(-1, 1))
-            self.num_turns -= 1
-        else:
-            self.owner.ai = self.old_ai
-            message("The {} is no longer confused!".format(self.owner.name),
+        self.owner.move(rng.ai.randint(-1, 1), rng.ai.randint(-1, 1))
+
+    def wear_off(self):
+        """Give the monster its old AI back, unless confused again since."""
+        monster = self.owner
+        (store, entity) = monster.row()
+        if (store.ai_kind[entity] != ConfusedMonster.kind or
+                store.ai_turns[entity] > scheduler.time):
+            return
+        monster.ai = self.old_ai
+        if monster in object_index:
+            message("The {} is no longer confused!".format(monster.name),
                     colors.amber)
 
 
-class Item:
+# AI classes by the store's ai_kind code.
+AI_KINDS = {cls.kind: cls for cls in (BasicMonster, ConfusedMonster)}
+
+
+class Item(ecs.Component):
     """Item that can be in inv. and used."""
+    __slots__ = ()
+    fields = ("use_function",)
+    use_function = ecs.Column("use")
+
     def __init__(self, use_function=None):
+        super().__init__()
         self.use_function = use_function
 
     def use(self):
@@ -205,7 +333,9 @@ class Item:
                     colors.amber)
         else:
             if self.use_function() != "cancelled":
+                stats["items_used"] += 1
                 player.inventory.remove(self.owner)
+                self.owner.destroy()
 
     def pick_up(self):
         """Add to inventory and remove from map."""
@@ -216,6 +346,7 @@ class Item:
         else:
             player.inventory.append(self.owner)
             objects.remove(self.owner)
+            object_index.remove(self.owner)
             message("You picked up a {}!".format(self.owner.name),
                     colors.green)
 
@@ -225,120 +356,252 @@ class Item:
         player.inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
+        object_index.add(self.owner)
         message("You dropped a {}".format(self.owner.name), colors.amber)
 
 
 def is_blocked(x, y):
     """Tests if given coords are blocked/blocking."""
-    if my_map[x][y].blocked:
+    if my_map.blocked[x, y]:
         return True
-    for obj in objects:
-        if obj.blocks and obj.x == x and obj.y == y:
-            return True
-    return False
+    return object_index.blocking_at(x, y) is not None
 
 
-def create_room(room):
+def create_room(game_map, room):
     """Create room on map from Rect class."""
-    global my_map
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            my_map[x][y].blocked = False
-            my_map[x][y].block_sight = False
+    game_map.carve(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
 
 
-def create_h_tunnel(x1, x2, y):
+def create_h_tunnel(game_map, x1, x2, y):
     """Create horizontal Tunnel."""
-    global my_map
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        my_map[x][y].blocked = False
-        my_map[x][y].block_sight = False
+    game_map.carve(min(x1, x2), y, max(x1, x2) + 1, y + 1)
 
 
-def create_v_tunnel(y1, y2, x):
+def create_v_tunnel(game_map, y1, y2, x):
     """Create Vertical Tunnel."""
-    global my_map
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        my_map[x][y].blocked = False
-        my_map[x][y].block_sight = False
-
-
-def is_visible_tile(x, y):
-    """Test if tile at coords is visible."""
-    global my_map
-    if x >= MAP_WIDTH or x < 0:
-        return False
-    elif y >= MAP_HEIGHT or y < 0:
-        return False
-    elif my_map[x][y].blocked == True:
-        return False
-    elif my_map[x][y].block_sight == True:
-        return False
-    else:
-        return True
+    game_map.carve(x, min(y1, y2), x + 1, max(y1, y2) + 1)
 
 
 def make_map():
-    """Make rooms and tunnels and map, on map."""
-    global my_map, objects
-    objects = [player]
-
+    """Generate the first level and put the player on it."""
+    enter_level(generate_level(1))
+
+
+def generate_level(depth):
+    """Make rooms and tunnels and map for level depth.
+
+    Touches no global game state, so it is safe to run on the level
+    pregeneration thread.
+    """
+    if settings.world == "chunked":
+        return generate_chunked_level(depth)
+    # Each level draws from its own streams, so it comes out the same
+    # whenever it is generated.
+    randint = rng.stream("map", depth).randint
+    spawn_rng = rng.stream("spawn", depth)
     # Make map of filled tiles.
-    my_map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    game_map = GameMap(MAP_WIDTH, MAP_HEIGHT, settings.fov_cache_size)
+    new_level = Level(depth, game_map, None)
+    place_rooms = ROOM_GENERATORS[settings.dungeon_generator]
+    rooms = place_rooms(randint, MAP_WIDTH, MAP_HEIGHT, settings.max_rooms)
+    carve_rooms(game_map, rooms, randint)
+    # The player starts in the center of the first room.
+    new_level.start = rooms[0].center()
+    for new_room in rooms:
+        place_objects(new_level, new_room, spawn_rng)
+    place_level_stairs(new_level, rooms)
+    return new_level
+
+
+def carve_rooms(game_map, rooms, randint):
+    """Carve rooms into game_map, each joined to the one before it."""
+    for num_rooms, new_room in enumerate(rooms):
+        # Draw room and get center of it.
+        create_room(game_map, new_room)
+        (new_x, new_y) = new_room.center()
+        if num_rooms > 0:
+            # Connect with tunnels.
+            (prev_x, prev_y) = rooms[num_rooms-1].center()
+            # 50/50 whether we go vert-hori or hori-vert.
+            if randint(0, 1):
+                create_h_tunnel(game_map, prev_x, new_x, prev_y)
+                create_v_tunnel(game_map, prev_y, new_y, new_x)
+            else:
+                create_v_tunnel(game_map, prev_y, new_y, prev_x)
+                create_h_tunnel(game_map, prev_x, new_x, new_y)
+
+
+def place_level_stairs(new_level, rooms):
+    """Stairs up where the player arrives, stairs down in the last room."""
+    if new_level.depth > 1:
+        place_stairs(new_level, new_level.start, -1)
+    if len(rooms) > 1:
+        place_stairs(new_level, rooms[-1].center(), 1)
+
+
+def chunk_path(depth):
+    """Return the file holding the chunks of level depth."""
+    return "{}.level-{}.chunks".format(world_prefix, depth)
+
+
+def open_chunked_map(new_level, width, height, path=None):
+    """Return ChunkedMap for new_level, reopening its file if it exists.
+
+    path defaults to chunk_path of the level's depth.
+    """
+    if path is None:
+        path = chunk_path(new_level.depth)
+    return ChunkedMap(width, height, path,
+                      lambda cx, cy, w, h: generate_chunk(new_level, cx, cy,
+                                                          w, h),
+                      settings.chunk_size, settings.chunk_cache_size,
+                      settings.fov_cache_size)
+
+
+def generate_chunked_level(depth):
+    """Make level depth as a ChunkedMap, generated chunk by chunk.
+
+    Only the chunk the player starts in is made now; the rest are made as
+    they are first looked at or walked into.
+    """
+    new_level = Level(depth, None, None)
+    new_level.game_map = open_chunked_map(new_level, MAP_WIDTH, MAP_HEIGHT)
+    new_level.game_map.chunk(0, 0)
+    (cx, cy, rooms) = new_level.unpopulated[0]
+    place_level_stairs(new_level, rooms)
+    populate_chunks(new_level)
+    return new_level
+
+
+def generate_chunk(new_level, cx, cy, width, height):
+    """Return tile bits of chunk (cx, cy) of new_level's ChunkedMap."""
+    randint = rng.stream("map", (new_level.depth, cx, cy)).randint
+    game_map = GameMap(width, height, settings.fov_cache_size)
+    rooms = bsp_rooms(randint, width, height, settings.chunk_rooms)
+    carve_rooms(game_map, rooms, randint)
+    (hub_x, hub_y) = rooms[0].center() if rooms else (width//2, height//2)
+    size = settings.chunk_size
+    if cx > 0:
+        create_v_tunnel(game_map, hub_y, height//2, hub_x)
+        create_h_tunnel(game_map, 0, hub_x, height//2)
+    if (cx + 1) * size < new_level.game_map.width:
+        create_v_tunnel(game_map, hub_y, height//2, hub_x)
+        create_h_tunnel(game_map, hub_x, width - 1, height//2)
+    if cy > 0:
+        create_h_tunnel(game_map, hub_x, width//2, hub_y)
+        create_v_tunnel(game_map, 0, hub_y, width//2)
+    if (cy + 1) * size < new_level.game_map.height:
+        create_h_tunnel(game_map, hub_x, width//2, hub_y)
+        create_v_tunnel(game_map, hub_y, height - 1, width//2)
+
+    # Rooms in map coords.
+    (x0, y0) = (cx * size, cy * size)
+    rooms = [Rect(room.x1 + x0, room.y1 + y0, room.x2 - room.x1,
+                  room.y2 - room.y1) for room in rooms]
+    if new_level.start is None:
+        (hub_x, hub_y) = (hub_x + x0, hub_y + y0)
+        new_level.start = rooms[0].center() if rooms else (hub_x, hub_y)
+    new_level.unpopulated.append((cx, cy, rooms))
+    return (game_map.blocked * np.uint8(BLOCKED) |
+            game_map.block_sight * np.uint8(BLOCK_SIGHT))
+
+
+def populate_chunks(lvl):
+    """Place monsters and items in the rooms of newly made chunks."""
+    while lvl.unpopulated:
+        (cx, cy, rooms) = lvl.unpopulated.pop()
+        spawn_rng = rng.stream("spawn", (lvl.depth, cx, cy))
+        for room in rooms:
+            place_objects(lvl, room, spawn_rng)
+
+
+def random_rooms(randint, width, height, max_rooms):
+    """Return up to max_rooms randomly placed rooms.
+
+    Rooms that would overlap or touch an earlier one are dropped. Candidates
+    are tested against a grid of the tiles taken so far, which costs the
+    area of the candidate instead of testing it against every placed room.
+    """
+    taken = np.zeros((width + 1, height + 1), dtype=bool, order="F")
     rooms = []
-    num_rooms = 0
-
-    for r in range(settings.max_rooms):
+    for r in range(max_rooms):
         # Random width, height, position inside map.
         w = randint(settings.room_min_size, settings.room_max_size)
         h = randint(settings.room_min_size, settings.room_max_size)
-        x = randint(0, MAP_WIDTH-w-1)
-        y = randint(0, MAP_HEIGHT-h-1)
-        # Create room from rect class.
-        new_room = Rect(x, y, w, h)
-        # Check if other rooms would intersect this one.
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-
-        if not failed:
-            # Therefore, room doesn't intersect.
-            # Draw room and get center of it.
-            create_room(new_room)
-            (new_x, new_y) = new_room.center()
-            # If first room, center player.
-            if num_rooms == 0:
-                player.x = new_x
-                player.spawnx = new_x
-                player.y = new_y
-                player.spawny = new_y
+        x = randint(0, width-w-1)
+        y = randint(0, height-h-1)
+        # Rooms sharing an edge count as overlapping.
+        footprint = taken[x:x+w+1, y:y+h+1]
+        if not footprint.any():
+            footprint[:] = True
+            rooms.append(Rect(x, y, w, h))
+    return rooms
+
+
+def bsp_rooms(randint, width, height, max_rooms):
+    """Return about max_rooms rooms from BSP partitioning.
+
+    The map is split in two along its longer side, the rooms wanted shared
+    out by area, and each half split again until one room is wanted or the
+    part is too small to split; every leaf then gets a room. Leaves come out
+    in tree order, so rooms next to each other in the list are close on the
+    map and the tunnels between them stay short.
+    """
+    # A leaf must fit the smallest room plus the wall on its far side.
+    min_leaf = settings.room_min_size + 1
+    rooms = []
+    # Explicit stack of (x, y, w, h, rooms wanted), right half pushed first.
+    stack = [(0, 0, width, height, max_rooms)]
+    while stack:
+        (x, y, w, h, wanted) = stack.pop()
+        horizontal = w >= h
+        side = w if horizontal else h
+        if wanted > 1 and side >= 2 * min_leaf:
+            cut = randint(min_leaf, side - min_leaf)
+            first = max(1, min(wanted - 1, round(wanted * cut / side)))
+            if horizontal:
+                stack.append((x + cut, y, w - cut, h, wanted - first))
+                stack.append((x, y, cut, h, first))
             else:
-                # Otherwise, connect with tunnels.
-                (prev_x, prev_y) = rooms[num_rooms-1].center()
-                # 50/50 whether we go vert-hori or hori-vert.
-                if randint(0, 1):
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
-
-            place_objects(new_room)
-            rooms.append(new_room)
-            num_rooms += 1
-
-
-def place_objects(room):
+                stack.append((x, y + cut, w, h - cut, wanted - first))
+                stack.append((x, y, w, cut, first))
+        elif w >= min_leaf and h >= min_leaf and wanted > 0:
+            room_w = randint(settings.room_min_size,
+                             min(settings.room_max_size, w - 1))
+            room_h = randint(settings.room_min_size,
+                             min(settings.room_max_size, h - 1))
+            rooms.append(Rect(randint(x, x + w - 1 - room_w),
+                              randint(y, y + h - 1 - room_h),
+                              room_w, room_h))
+    return rooms
+
+
+ROOM_GENERATORS = {"random": random_rooms,
+                   "bsp": bsp_rooms}
+
+
+def place_stairs(new_level, pos, direction):
+    """Add staircase going direction (1 down, -1 up) at pos."""
+    (x, y) = pos
+    if direction > 0:
+        stairs = GameObject(x, y, ">", "stairs down", colors.white, stairs=1,
+                            store=new_level.store)
+    else:
+        stairs = GameObject(x, y, "<", "stairs up", colors.white, stairs=-1,
+                            store=new_level.store)
+    new_level.add(stairs, back=True)
+    new_level.stairs[direction] = pos
+
+
+def place_objects(new_level, room, spawn_rng):
     """Add Monsters/Items to rooms."""
+    randint = spawn_rng.randint
     num_monsters = randint(0, settings.max_room_monsters)
     for i in range(num_monsters):
         x = randint(room.x1+1, room.x2-1)
         y = randint(room.y1+1, room.y2-1)
-        if not is_blocked(x, y):
+        # Keep the player's arrival tile free.
+        if not new_level.is_blocked(x, y) and (x, y) != new_level.start:
             if randint(0, 100) < 80:
                 fighter_component = Fighter(hp=10,
                                             defense=0,
@@ -348,7 +611,7 @@ def place_objects(room):
                 monster = GameObject(x, y, "o", "orc",
                                      colors.desaturated_green,
                                      blocks=True, fighter=fighter_component,
-                                     ai=ai_component)
+                                     ai=ai_component, store=new_level.store)
             else:
                 fighter_component = Fighter(hp=16,
                                             defense=1,
@@ -357,35 +620,87 @@ def place_objects(room):
                 ai_component = BasicMonster()
                 monster = GameObject(x, y, "T", "troll", colors.darker_green,
                                      blocks=True, fighter=fighter_component,
-                                     ai=ai_component)
-            objects.append(monster)
+                                     ai=ai_component, store=new_level.store)
+            new_level.add(monster)
 
     num_items = randint(0, settings.max_room_items)
     for i in range(num_items):
         x = randint(room.x1+1, room.x2-1)
         y = randint(room.y1+1, room.y2-1)
 
-        if not is_blocked(x, y):
+        if not new_level.is_blocked(x, y):
             dice = randint(0, 100)
             if dice < 70:
                 item_component = Item(use_function=cast_heal)
                 item = GameObject(x, y, "!", "healing potion", colors.violet,
-                                  item=item_component)
+                                  item=item_component, store=new_level.store)
             elif dice < 70+10:
                 item_component = Item(use_function=cast_lightning)
                 item = GameObject(x, y, "#", "scroll of lightning",
-                                  colors.light_yellow, item=item_component)
+                                  colors.light_yellow, item=item_component,
+                                  store=new_level.store)
             elif dice < 70+10+10:
                 item_component = Item(use_function=cast_fireball)
                 item = GameObject(x, y, "#", "scroll of fireball",
-                                  colors.red, item=item_component)
+                                  colors.red, item=item_component,
+                                  store=new_level.store)
             else:
                 item_component = Item(use_function=cast_confuse)
                 item = GameObject(x, y, "#", "scroll of confusion",
-                                  colors.purple, item=item_component)
+                                  colors.purple, item=item_component,
+                                  store=new_level.store)
+
+            new_level.add(item, back=True)
+
+
+def enter_level(new_level, pos=None):
+    """Make new_level the current one, with the player at pos or its start."""
+    global level, my_map, objects, object_index, entities
+    level = new_level
+    my_map = level.game_map
+    objects = level.objects
+    object_index = level.object_index
+    entities = level.store
+    # The player and what they carry go wherever they go.
+    for obj in [player] + player.inventory:
+        obj.move_to_store(entities)
+    (player.x, player.y) = pos if pos is not None else level.start
+    (player.spawnx, player.spawny) = level.start
+    objects.append(player)
+    object_index.add(player)
+    populate_chunks(level)
+
+
+def change_level(direction):
+    """Take the stairs: 1 goes down a level, -1 up."""
+    depth = level.depth + direction
+    objects.remove(player)
+    object_index.remove(player)
+    # Everything on the level left behind goes dormant.
+    level.active.update(())
+    levels.put(level)
+    if depth in levels:
+        new_level = levels.take(depth)
+    else:
+        new_level = pregenerator.take(depth)
+    # Arrive on the staircase leading back the way we came.
+    enter_level(new_level, new_level.stairs.get(-direction))
+    init_render_state()
+    # Monsters may act before the next frame, in real time, and need to
+    # know what the player can see.
+    update_fov()
+    if direction > 0:
+        message("You descend to level {}.".format(depth), colors.light_violet)
+    else:
+        message("You climb back up to level {}.".format(depth),
+                colors.light_violet)
+    pregenerate_next()
+
 
-            objects.append(item)
-            item.send_to_back()
+def pregenerate_next():
+    """Have the level below this one generated in the background."""
+    if level.stairs.get(1) is not None and level.depth + 1 not in levels:
+        pregenerator.request(level.depth + 1)
 
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
@@ -399,77 +714,223 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     panel.draw_str(x_centered, y, text, fg=colors.white, bg=None)
 
 
+def in_view(x, y):
+    """Return True if map coords are inside the camera's view."""
+    return (camera_x <= x < camera_x + VIEW_WIDTH and
+            camera_y <= y < camera_y + VIEW_HEIGHT)
+
+
+def mouse_tile():
+    """Return map coords of the tile under the mouse, or None."""
+    (x, y) = mouse_coord
+    if not (0 <= x < VIEW_WIDTH and 0 <= y < VIEW_HEIGHT):
+        return None
+    return (x + camera_x, y + camera_y)
+
+
+def update_camera():
+    """Centre the camera on the player, keeping it on the map.
+
+    Scrolling moves every cell on screen, so it makes the next render a
+    full redraw.
+    """
+    global camera_x, camera_y
+    x = min(max(0, player.x - VIEW_WIDTH // 2),
+            max(0, my_map.width - VIEW_WIDTH))
+    y = min(max(0, player.y - VIEW_HEIGHT // 2),
+            max(0, my_map.height - VIEW_HEIGHT))
+    if (x, y) != (camera_x, camera_y):
+        (camera_x, camera_y) = (x, y)
+        mark_all_dirty()
+
+
 def get_names_under_mouse():
     """Get name of objects under mouse."""
-    global visible_tiles
-    (x, y) = mouse_coord
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and (obj.x, obj.y) in visible_tiles]
+    tile = mouse_tile()
+    if tile is None or not visible[tile]:
+        return ""
+    names = [obj.name for obj in object_index.at(*tile)]
     names = ", ".join(names)
     return names.capitalize()
 
 
+def mark_dirty(x, y):
+    """Have render_all redraw the cell at coords."""
+    dirty_cells.add((x, y))
+
+
+def mark_all_dirty():
+    """Have render_all redraw the whole map."""
+    global full_redraw
+    full_redraw = True
+
+
+def top_object(x, y):
+    """Return the object drawn on top at coords, or None."""
+    top = None
+    for obj in object_index.at(x, y):
+        if obj == player:
+            return obj
+        # Blocking objects (monsters) draw over items and corpses.
+        if top is None or obj.blocks or not top.blocks:
+            top = obj
+    return top
+
+
+def draw_cell(x, y):
+    """Draw map tile at coords, without objects, if in view."""
+    if not in_view(x, y):
+        return
+    wall = my_map.block_sight[x, y]
+    if visible[x, y]:
+        bg = color_light_wall if wall else color_light_ground
+    elif my_map.explored[x, y]:
+        bg = color_dark_wall if wall else color_dark_ground
+    else:
+        bg = colors.black
+    con.draw_char(x - camera_x, y - camera_y, " ", None, bg=bg)
+
+
+def draw_object(x, y):
+    """Draw top object at coords over its tile, if visible and in view."""
+    if not (in_view(x, y) and visible[x, y]):
+        return
+    obj = top_object(x, y)
+    if obj is not None:
+        con.draw_char(x - camera_x, y - camera_y, obj.char, obj.fg, bg=None)
+
+
+def draw_map_bulk():
+    """Draw every cell in view and visible object with one write per plane."""
+    profiler.start("map")
+    x1 = min(my_map.width, camera_x + VIEW_WIDTH)
+    y1 = min(my_map.height, camera_y + VIEW_HEIGHT)
+    (wall, explored) = my_map.known_area(camera_x, camera_y, x1, y1)
+    lit = visible.crop(camera_x, camera_y, x1, y1)
+    # Off the edge of a map smaller than the view stays unexplored.
+    shade = np.full((VIEW_WIDTH, VIEW_HEIGHT), 4, dtype=np.intp, order="F")
+    (width, height) = wall.shape
+    shade[:width, :height] = lit * 2 + wall
+    shade[:width, :height][~(lit | explored)] = 4
+    bg = TILE_PALETTE[shade]
+    ch = np.full(shade.shape, ord(" "), dtype=np.intc)
+    fg = np.zeros(bg.shape, dtype=np.intc)
+    profiler.stop()
+    profiler.start("objects")
+    # Only visible objects are drawn, so the FOV bounds the loop; their
+    # glyphs are then copied out of the entity store in one go.
+    cells = []
+    ids = []
+    for (x, y) in zip(*(lit.nonzero())):
+        obj = top_object(int(x) + camera_x, int(y) + camera_y)
+        if obj is not None:
+            cells.append((x, y))
+            ids.append(obj.id)
+    if ids:
+        (xs, ys) = np.array(cells).T
+        ch[xs, ys] = entities.char[ids]
+        fg[xs, ys] = entities.fg[ids]
+    profiler.stop()
+    with profiler.section("map"):
+        backend.fill(con, ch, fg, bg)
+
+
+def init_render_state():
+    """Forget what was drawn; the next render_all redraws everything."""
+    global fov_recompute, visible, dirty_cells, mouse_coord
+    global camera_x, camera_y, panel_shown
+    mouse_coord = (0, 0)
+    panel_shown = None
+    (camera_x, camera_y) = (0, 0)
+    fov_recompute = True
+    visible = Window.empty()
+    dirty_cells = set()
+    mark_all_dirty()
+    con.clear()
+
+
+def update_fov():
+    """Recompute FOV; return set of cells whose visibility changed."""
+    global visible
+    new_visible = my_map.compute_fov(player.x, player.y,
+                                     fov=settings.fov_algo,
+                                     radius=settings.torch_radius,
+                                     light_walls=settings.fov_light_walls)
+    # Newly explored cells are always newly visible too, so the cells
+    # that differ cover them.
+    changed = new_visible.changed(visible)
+    my_map.explored[new_visible.slices()] |= new_visible.mask
+    visible = new_visible
+    return changed
+
+
 def render_all():
-    """Render FOV, tiles and objects."""
-    global fov_recompute
-    global visible_tiles
+    """Render FOV, tiles and objects.
+
+    Only cells that changed since the last frame are redrawn: those whose
+    visibility flipped and those objects moved from, moved to or changed on.
+    """
+    global fov_recompute, full_redraw, panel_shown
+    dirty = object_index.pop_changed()
+    dirty |= dirty_cells
+    dirty_cells.clear()
     if fov_recompute:
         fov_recompute = False
-        visible_tiles = tdl.map.quickFOV(player.x, player.y,
-                                         is_visible_tile,
-                                         fov=settings.fov_algo,
-                                         radius=settings.torch_radius,
-                                         lightWalls=settings.fov_light_walls)
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = (x, y) in visible_tiles
-                wall = my_map[x][y].block_sight
-                if not visible:
-                    if my_map[x][y].explored:
-                        if wall:
-                            con.draw_char(x, y, None, fg=None,
-                                          bg=color_dark_wall)
-                        else:
-                            con.draw_char(x, y, None, fg=None,
-                                          bg=color_dark_ground)
-                else:
-                    if wall:
-                        con.draw_char(x, y, None, fg=None, bg=color_light_wall)
-                    else:
-                        con.draw_char(x, y, None, fg=None,
-                                      bg=color_light_ground)
-                    my_map[x][y].explored = True
-    for obj in objects:
-        if obj != player:
-            obj.draw()
-    player.draw()
+        with profiler.section("fov"):
+            dirty |= update_fov()
+    update_camera()
+    if full_redraw or len(dirty) > BULK_REDRAW_CELLS:
+        full_redraw = False
+        draw_map_bulk()
+    else:
+        with profiler.section("map"):
+            for (x, y) in dirty:
+                draw_cell(x, y)
+        with profiler.section("objects"):
+            for (x, y) in dirty:
+                draw_object(x, y)
 
     # Blit the contents of "con" to the root console and present it.
-    root.blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0)
+    with profiler.section("map"):
+        root.blit(con, 0, 0, VIEW_WIDTH, VIEW_HEIGHT, 0, 0)
+
+    # Draw gui panel, only if something on it changed.
+    profiler.start("panel")
+    names = get_names_under_mouse()
+    shown = (player.fighter.hp, player.fighter.max_hp, names)
+    if game_msgs.dirty or shown != panel_shown or profiler.overlay:
+        draw_panel(names)
+        game_msgs.dirty = False
+        panel_shown = shown
+    root.blit(panel, 0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0)
+    profiler.stop()
+
 
-    # Draw gui panel.
+def draw_panel(names):
+    """Draw messages, HP bar and names under the mouse on the panel.
+
+    With the profiler overlay on, frame timings replace the messages.
+    """
     panel.clear(fg=colors.white, bg=colors.black)
+    if profiler.overlay:
+        lines = [(line, colors.light_gray)
+                 for line in profiler.report(MSG_HEIGHT)]
+    else:
+        lines = game_msgs.lines(MSG_WIDTH, MSG_HEIGHT)
     y = 1
-    for (line, color) in game_msgs:
+    for (line, color) in lines:
         panel.draw_str(MSG_X, y, line, bg=None, fg=color)
         y += 1
 
     render_bar(1, 1, BAR_WIDTH, "HP", player.fighter.hp, player.fighter.max_hp,
                colors.light_red, colors.darker_red)
 
-    panel.draw_str(1, 0, get_names_under_mouse(), bg=None,
-                   fg=colors.light_gray)
-
-    root.blit(panel, 0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0)
+    panel.draw_str(1, 0, names, bg=None, fg=colors.light_gray)
 
 
 def message(new_msg, color=colors.white):
     """Func for displaying message to GUI."""
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
-    for line in new_msg_lines:
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
-        game_msgs.append((line, color))
+    game_msgs.add(new_msg, color)
 
 
 def player_move_or_attack(dx, dy):
@@ -478,8 +939,8 @@ def player_move_or_attack(dx, dy):
     x = player.x + dx
     y = player.y + dy
     target = None
-    for obj in objects:
-        if obj.fighter and obj.x == x and obj.y == y:
+    for obj in object_index.at(x, y):
+        if obj.fighter:
             target = obj
             break
 
@@ -499,7 +960,7 @@ def menu(header, options, width):
     header_height = len(header_wrapped)
     height = len(options) + header_height
 
-    window = tdl.Console(width, height)
+    window = backend.new_console(width, height)
     window.draw_rect(0, 0, width, height, None, fg=colors.white, bg=None)
     for i, line in enumerate(header_wrapped):
         window.draw_str(0, 0+i, header_wrapped[i])
@@ -516,8 +977,8 @@ def menu(header, options, width):
     y = SCREEN_HEIGHT//2 - height//2
     root.blit(window, x, y, width, height, 0, 0)
 
-    tdl.flush()
-    key = tdl.event.key_wait()
+    backend.flush()
+    key = wait_for_player(backend.wait_key)
     key_char = key.char
     if key_char == "":
         key_char = " "  # TODO: PLACEHOLDER
@@ -547,27 +1008,61 @@ def msgbox(text, width=50):
     menu(text, [], width)
 
 
+def wait_for_player(wait):
+    """Return wait(), a blocking read of input, counting how often it ran.
+
+    The real-time loop checks blocked to stop the game clock while a menu
+    or targeting waits for the player.
+    """
+    global blocked
+    with profiler.section(WAIT):
+        result = wait()
+    blocked += 1
+    return result
+
+
 def handle_keys():
-    """Handle keys from user."""
+    """Wait for the next input event and handle it, as handle_event."""
+    return handle_event(wait_for_player(backend.wait_event))
+
+
+def handle_event(event):
+    """Handle input event, which may be None.
+
+    Returns "idle" if the event changed nothing on screen, so the caller
+    can skip redrawing.
+    """
     global playerx, playery
     global fov_recompute
     global mouse_coord
-
-    keypress = False
-    for event in tdl.event.get():
-        if event.type == "KEYDOWN":
-            user_input = event
-            keypress = True
-        if event.type == "MOUSEMOTION":
-            mouse_coord = event.cell
-
-    if not keypress:
+    global panel_shown
+
+    if event is None:
+        return "idle"
+    if event.type == "MOUSEMOTION":
+        # Motion within one cell cannot change the names under the mouse.
+        if event.cell == mouse_coord:
+            return "idle"
+        mouse_coord = event.cell
         return "didnt-take-turn"
+    if event.type != "KEYDOWN":
+        return "idle"
+    user_input = event
 
     if user_input.key == "ENTER" and user_input.control:
-        tdl.set_fullscreen(not tdl.get_fullscreen())
+        backend.toggle_fullscreen()
     elif user_input.key == "ESCAPE":
         return "exit"
+    elif user_input.key == "PAGEUP":
+        game_msgs.scroll_by(MSG_HEIGHT - 1, MSG_WIDTH, MSG_HEIGHT)
+        return "didnt-take-turn"
+    elif user_input.key == "PAGEDOWN":
+        game_msgs.scroll_by(-(MSG_HEIGHT - 1), MSG_WIDTH, MSG_HEIGHT)
+        return "didnt-take-turn"
+    elif user_input.key == "F3":
+        profiler.overlay = not profiler.overlay
+        panel_shown = None
+        return "didnt-take-turn"
 
     if game_state == "playing":
         if user_input.key == "UP":
@@ -580,8 +1075,8 @@ def handle_keys():
             player_move_or_attack(1, 0)
         else:
             if user_input.text == "g":
-                for obj in objects:
-                    if obj.x == player.x and obj.y == player.y and obj.item:
+                for obj in object_index.at(player.x, player.y):
+                    if obj.item:
                         obj.item.pick_up()
                         break
 
@@ -597,13 +1092,96 @@ def handle_keys():
                 if chosen_item is not None:
                     chosen_item.drop()
 
+            if user_input.text in (">", "<"):
+                direction = 1 if user_input.text == ">" else -1
+                for obj in object_index.at(player.x, player.y):
+                    if obj.stairs == direction:
+                        change_level(direction)
+                        break
+
             return "didnt-take-turn"
 
 
+def update_active():
+    """Wake monsters within WAKE_RADIUS of the player; let the rest sleep.
+
+    Monsters that wake up are scheduled to act this turn. Dormant ones are
+    dropped from the schedule when their turn comes up.
+    """
+    nearby = [obj for obj in object_index.within(player.x, player.y,
+                                                 WAKE_RADIUS)
+              if entities.ai_kind[obj.id]]
+    for monster in level.active.update(nearby):
+        if monster not in scheduler:
+            scheduler.schedule(monster, scheduler.time)
+
+
+def take_monster_turns():
+    """Run every monster and effect due before the player's next action."""
+    update_active()
+    while True:
+        due = scheduler.pop(scheduler.time)
+        if due is None:
+            break
+        (when, effects, actors) = due
+        for effect in effects:
+            effect()
+        actors = [actor for actor in actors
+                  if actor in level.active and entities.ai_kind[actor.id]]
+        ids = np.array(sorted(actor.id for actor in actors), dtype=np.intp)
+        kinds = entities.ai_kind[ids]
+        for entity in ids[kinds != BasicMonster.kind].tolist():
+            entities.handle[entity].ai.take_turn()
+        basic = ids[kinds == BasicMonster.kind]
+        if basic.size:
+            basic_monster_turns(basic)
+        for actor in actors:
+            if entities.ai_kind[actor.id]:
+                scheduler.schedule(actor, when + delay(actor.speed))
+    scheduler.time += delay(player.speed)
+
+
+def basic_monster_turns(ids):
+    """Give the BasicMonsters with entity ids their turns, all at once."""
+    monsters = [entities.handle[entity] for entity in ids.tolist()]
+    xs = entities.x[ids].astype(np.intp)
+    ys = entities.y[ids].astype(np.intp)
+    awake = visible[xs, ys]
+    in_reach = (player.x - xs) ** 2 + (player.y - ys) ** 2 < 1.41 ** 2
+
+    for i in np.flatnonzero(awake & in_reach).tolist():
+        if player.fighter.hp > 0:
+            monsters[i].fighter.attack(player)
+
+    chasing = np.flatnonzero(awake & ~in_reach)
+    if not chasing.size:
+        return
+    player_flow.update(my_map, player.x, player.y, CHASE_RADIUS)
+    reachable = player_flow.reachable(xs[chasing], ys[chasing])
+    for i in chasing[~reachable].tolist():
+        monsters[i].move_towards(player.x, player.y)
+    chasing = chasing[reachable]
+
+    (area_x, area_y) = player_flow.window()
+    occupied = my_map.blocked[area_x, area_y].copy()
+    for (x, y) in object_index.blocking_in(area_x.start, area_y.start,
+                                           area_x.stop, area_y.stop):
+        occupied[x - area_x.start, y - area_y.start] = True
+    new_xs, new_ys, moved = player_flow.steps(xs[chasing], ys[chasing],
+                                              occupied)
+    for i, x, y in zip(chasing[moved].tolist(), new_xs[moved].tolist(),
+                       new_ys[moved].tolist()):
+        monster = monsters[i]
+        monster.x = x
+        monster.y = y
+        object_index.update(monster)
+
+
 def player_death(player):
     """Death animation for player."""
     global game_state
     game_state = "dead"
+    mark_dirty(player.x, player.y)
     message("You died!", colors.darker_red)
     player.char = "%"
     player.fg = colors.dark_red
@@ -612,7 +1190,11 @@ def player_death(player):
 
 def monster_death(monster):
     """Death animation for monster."""
+    stats["kills"] += 1
+    level.active.discard(monster)
+    scheduler.unschedule(monster)
     message("{} is dead!".format(monster.name.capitalize()), colors.azure)
+    mark_dirty(monster.x, monster.y)
     monster.char = "%"
     monster.fg = colors.dark_red
     monster.blocks = False
@@ -625,24 +1207,32 @@ def monster_death(monster):
 def target_tile(max_range=None):
     """Return position of left-clicked tile in FOV."""
     global mouse_coord
+    redraw = True
     while True:
-        tdl.flush()
+        if backend.is_closed():
+            return (None, None)
+        if redraw:
+            # Keeps the names under the mouse up to date while aiming.
+            render_all()
+            backend.flush()
+        event = wait_for_player(backend.wait_event)
+        redraw = False
+        if event is None:
+            continue
         clicked = False
-        for event in tdl.event.get():
-            if event.type == "MOUSEMOTION":
-                mouse_coord = event.cell
-            if event.type == "MOUSEDOWN" and event.button == "LEFT":
-                clicked = True
-            elif ((event.type == 'MOUSEDOWN' and event.button == 'RIGHT') or
-                  (event.type == 'KEYDOWN' and event.key == 'ESCAPE')):
-                    return (None, None)
-        render_all()
+        if event.type in ("MOUSEMOTION", "MOUSEDOWN"):
+            redraw = event.cell != mouse_coord
+            mouse_coord = event.cell
+        if event.type == "MOUSEDOWN" and event.button == "LEFT":
+            clicked = True
+        elif ((event.type == 'MOUSEDOWN' and event.button == 'RIGHT') or
+              (event.type == 'KEYDOWN' and event.key == 'ESCAPE')):
+                return (None, None)
 
-        x = mouse_coord[0]
-        y = mouse_coord[1]
-        if (clicked and mouse_coord in visible_tiles and
-           (max_range is None or player.distance(x, y) <= max_range)):
-            return mouse_coord
+        tile = mouse_tile()
+        if (clicked and tile is not None and visible[tile] and
+           (max_range is None or player.distance(*tile) <= max_range)):
+            return tile
 
 
 def target_monster(max_range=None):
@@ -652,8 +1242,8 @@ def target_monster(max_range=None):
         if x is None:
             return None
 
-        for obj in objects:
-            if obj.x == x and obj.y == y and obj.fighter and obj != player:
+        for obj in object_index.at(x, y):
+            if obj.fighter and obj != player:
                 return obj
 
 
@@ -662,8 +1252,8 @@ def closest_monster(max_range):
     closest_enemy = None
     closest_dist = max_range + 1
 
-    for obj in objects:
-        if (obj.fighter) and (not obj == player) and ((obj.x, obj.y) in visible_tiles):
+    for obj in object_index.fighters_within(player.x, player.y, max_range):
+        if (not obj == player) and visible[obj.x, obj.y]:
             dist = player.distance_to(obj)
             if dist < closest_dist:
                 closest_enemy = obj
@@ -705,7 +1295,6 @@ def cast_confuse():
         return "cancelled"
     old_ai = monster.ai
     monster.ai = ConfusedMonster(old_ai)
-    monster.ai.owner = monster
     message("The eyes of {} look vacant, "
             "as it stumbles around.".format(monster.name), colors.light_blue)
 
@@ -721,8 +1310,8 @@ def cast_fireball():
     message("The fireball explodes, burning everything "
             "within {} tiles!".format(settings.fireball_radius), colors.amber)
 
-    for obj in objects:
-        if obj.distance(x, y) <= settings.fireball_radius and obj.fighter:
+    for obj in object_index.fighters_within(x, y, settings.fireball_radius):
+        if obj.fighter:
             message("The {} is burned "
                     "for {}HP!".format(obj.name,
                                        settings.fireball_damage))
@@ -744,20 +1333,22 @@ def cast_teleport(max_range=settings.teleport_range, x=None, y=None):
                     colors.blue)
             player.x = x
             player.y = y
+            object_index.update(player)
             fov_recompute = True
-            player.draw()
+            mark_all_dirty()
             render_all()
-            tdl.flush()
+            backend.flush()
         else:
             message("Tile out of range; cancelled.", colors.blue)
             return "cancelled"
     else:
         player.x = x
         player.y = y
+        object_index.update(player)
         fov_recompute = True
-        player.draw()
+        mark_all_dirty()
         render_all()
-        tdl.flush()
+        backend.flush()
 
 
 def cast_teleporthome():
@@ -766,86 +1357,394 @@ def cast_teleporthome():
     cast_teleport(x=player.spawnx, y=player.spawny)
 
 
-def save_game():
-    """Open an new empty shelf to write data."""
-    with shelve.open("savegame/savegame", "n") as savefile:
-        savefile["my_map"] = my_map
-        savefile["objects"] = objects
-        savefile["player_index"] = objects.index(player)
-        savefile["inventory"] = player.inventory
-        savefile["game_msgs"] = game_msgs
-        savefile["game_state"] = game_state
-
-
-def load_game():
-    global my_map, objects, player, game_msgs, game_state
-
-    with shelve.open("savegame/savegame", "r") as savefile:
-        my_map = savefile["my_map"]
-        objects = savefile["objects"]
-        player = objects[savefile["player_index"]]
-        player.inventory = savefile["inventory"]
-        game_msgs = savefile["game_msgs"]
-        game_state = savefile["game_state"]
-
-
-def new_game():
-    """Init GameObjects for new game state."""
-    global player, game_msgs, game_state
+# Functions and AI classes a save file may refer to by name.
+SAVE_FUNCTIONS = {func.__name__: func for func in
+                  (player_death, monster_death, cast_heal, cast_lightning,
+                   cast_confuse, cast_fireball, cast_teleport,
+                   cast_teleporthome)}
+SAVE_AI = {cls.__name__: cls for cls in (BasicMonster, ConfusedMonster)}
+
+
+def encode_object(obj, strings, flags=0):
+    """Return obj as a tuple laid out like savefile.OBJECT_DTYPE."""
+    if obj.blocks:
+        flags |= savefile.BLOCKS
+    hp = max_hp = defense = power = death = 0
+    if obj.fighter:
+        flags |= savefile.FIGHTER
+        fighter = obj.fighter
+        hp, max_hp = fighter.hp, fighter.max_hp
+        defense, power = fighter.defense, fighter.power
+        if fighter.death_function is not None:
+            death = strings.intern(fighter.death_function.__name__)
+    ai = old_ai = ai_turns = 0
+    if obj.ai:
+        ai = strings.intern(type(obj.ai).__name__)
+        if isinstance(obj.ai, ConfusedMonster):
+            old_ai = strings.intern(type(obj.ai.old_ai).__name__)
+            ai_turns = obj.ai.num_turns
+    if obj.stairs > 0:
+        flags |= savefile.STAIRS_DOWN
+    elif obj.stairs < 0:
+        flags |= savefile.STAIRS_UP
+    use = 0
+    if obj.item:
+        flags |= savefile.ITEM
+        if obj.item.use_function is not None:
+            use = strings.intern(obj.item.use_function.__name__)
+    (r, g, b) = obj.fg
+    return (obj.x, obj.y, ord(obj.char), r, g, b, flags,
+            strings.intern(obj.name), ai, old_ai, ai_turns,
+            hp, max_hp, defense, power, death, use, obj.speed)
+
+
+def decode_object(record, strings, store):
+    """Return new GameObject in store from a savefile.OBJECT_DTYPE record."""
+    (x, y, char, r, g, b, flags, name, ai, old_ai, ai_turns,
+     hp, max_hp, defense, power, death, use, speed) = record
+    fighter_component = ai_component = item_component = None
+    if flags & savefile.FIGHTER:
+        fighter_component = Fighter(max_hp, defense, power,
+                                    SAVE_FUNCTIONS.get(strings[death]))
+        fighter_component.hp = hp
+    if ai:
+        ai_class = SAVE_AI[strings[ai]]
+        if ai_class is ConfusedMonster:
+            ai_component = ConfusedMonster(SAVE_AI[strings[old_ai]](),
+                                           ai_turns)
+        else:
+            ai_component = ai_class()
+    if flags & savefile.ITEM:
+        item_component = Item(SAVE_FUNCTIONS.get(strings[use]))
+    stairs = 0
+    if flags & savefile.STAIRS_DOWN:
+        stairs = 1
+    elif flags & savefile.STAIRS_UP:
+        stairs = -1
+    obj = GameObject(x, y, chr(char), strings[name], (r, g, b),
+                     blocks=bool(flags & savefile.BLOCKS),
+                     fighter=fighter_component, ai=ai_component,
+                     item=item_component, stairs=stairs, speed=speed,
+                     store=store)
+    return obj
+
+
+def snapshot_level(lvl, strings, inventory=(), msgs=(), meta=None):
+    """Return the arguments savefile.write needs to save lvl.
+
+    Everything is copied, so the snapshot can be written on another thread
+    while the game carries on.
+    """
+    game_map = lvl.game_map
+    records = [encode_object(obj, strings) for obj in lvl.objects]
+    records += [encode_object(obj, strings, savefile.IN_INVENTORY)
+                for obj in inventory]
+    msgs = [(strings.intern(line),) + tuple(color) for (line, color) in msgs]
+    meta = dict(meta or {})
+    meta.update(depth=lvl.depth, start_x=lvl.start[0], start_y=lvl.start[1])
+    if isinstance(game_map, ChunkedMap):
+        # The tiles stay in the chunk file beside the save.
+        game_map.flush()
+        meta["chunks"] = strings.intern(os.path.abspath(game_map.path))
+        layers = {}
+    else:
+        layers = {"blocked": game_map.blocked.copy(),
+                  "block_sight": game_map.block_sight.copy(),
+                  "explored": game_map.explored.copy()}
+    return (game_map.width, game_map.height, layers,
+            np.array(records, dtype=savefile.OBJECT_DTYPE),
+            np.array(msgs, dtype=savefile.MESSAGE_DTYPE),
+            strings, meta)
+
+
+def read_level(save):
+    """Return (Level, inventory) rebuilt from an open savefile.SaveReader."""
+    strings = save.strings
+    meta = save.meta
+    lvl = Level(meta.get("depth", 1), None,
+                (meta.get("start_x", 0), meta.get("start_y", 0)))
+    if meta.get("chunks"):
+        lvl.game_map = open_chunked_map(lvl, save.width, save.height,
+                                        strings[meta["chunks"]])
+    else:
+        lvl.game_map = GameMap(save.width, save.height,
+                               settings.fov_cache_size)
+        lvl.game_map.blocked[:] = save.layer("blocked")
+        lvl.game_map.block_sight[:] = save.layer("block_sight")
+        lvl.game_map.explored[:] = save.layer("explored")
+    inventory = []
+    for record, flags in zip(save.objects.tolist(),
+                             save.objects["flags"].tolist()):
+        obj = decode_object(record, strings, lvl.store)
+        if flags & savefile.IN_INVENTORY:
+            inventory.append(obj)
+            continue
+        lvl.add(obj)
+        if obj.stairs:
+            lvl.stairs[obj.stairs] = (obj.x, obj.y)
+    return lvl, inventory
+
+
+def snapshot_cached_level(lvl):
+    """Return snapshot of lvl on its own, for the level cache."""
+    populate_chunks(lvl)
+    return snapshot_level(lvl, savefile.StringTable())
+
+
+def decode_level(data):
+    """Return the Level held in bytes saved by the level cache."""
+    with savefile.SaveReader(data) as save:
+        return read_level(save)[0]
+
+
+def snapshot_game():
+    """Return the arguments savefile.write needs to save the game.
+
+    Only the current level goes in the save itself; the level cache writes
+    the others alongside it.
+    """
+    populate_chunks(level)
+    strings = savefile.StringTable()
+    meta = {"player_index": objects.index(player),
+            "spawn_x": player.spawnx,
+            "spawn_y": player.spawny,
+            "game_state": strings.intern(game_state),
+            "turn": turn,
+            "seed": rng.seed}
+    return snapshot_level(level, strings, player.inventory, game_msgs, meta)
+
+
+def save_game(path=SAVE_PATH):
+    """Write game to path in the binary save format."""
+    autosaver.wait()
+    levels.flush()
+    savefile.write(path, *snapshot_game())
+
+
+def autosave(path=SAVE_PATH):
+    """Save in the background without holding up the game."""
+    if autosaver.error is not None:
+        message("Autosave failed: {}".format(autosaver.error), colors.red)
+        autosaver.error = None
+    if autosaver.busy():
+        return
+    # Levels are copied here; compressing and writing them, like the save
+    # itself, is left to the autosaver's thread.
+    changed = levels.snapshot_changed()
+    autosaver.save(path, snapshot_game(), lambda: levels.write(changed))
+
+
+def load_game(path=SAVE_PATH):
+    global level, my_map, objects, object_index, entities, player, game_msgs
+    global game_state, turn, rng, scheduler
+
+    with savefile.SaveReader(path) as save:
+        strings = save.strings
+        meta = save.meta
+        # Before the objects, so timed effects are due from the saved turn.
+        scheduler = Scheduler(meta.get("turn", 0) * TURN)
+        level, inventory = read_level(save)
+        game_msgs = MessageLog(settings.message_history)
+        for (text, r, g, b) in save.messages.tolist():
+            game_msgs.add(strings[text], (r, g, b))
+
+    reset_levels(path)
+    my_map = level.game_map
+    objects = level.objects
+    object_index = level.object_index
+    entities = level.store
+    player = objects[meta["player_index"]]
+    player.inventory = inventory
+    player.spawnx = meta["spawn_x"]
+    player.spawny = meta["spawn_y"]
+    game_state = strings[meta["game_state"]]
+    turn = meta.get("turn", 0)
+    rng = RandomStreams(meta.get("seed", 0), turn)
+
+
+def reset_levels(save_path=None, clear=False):
+    """Start a fresh level cache, storing levels beside save_path.
+
+    With save_path None evicted levels stay compressed in memory, and the
+    chunks of chunked levels go to a new temporary folder, deleted with
+    the game. clear deletes level files left over from an earlier game.
+    """
+    global levels, world_prefix, world_folder
+    pregenerator.cancel()
+    remove_world_folder()
+    if save_path is not None:
+        world_prefix = save_path
+    elif settings.world == "chunked":
+        world_folder = tempfile.TemporaryDirectory(
+            prefix="umbrella-", ignore_cleanup_errors=True)
+        world_prefix = os.path.join(world_folder.name, "world")
+    levels = LevelCache(settings.level_cache_size, snapshot_cached_level,
+                        decode_level, prefix=save_path)
+    if clear:
+        levels.clear()
+
+
+def remove_world_folder():
+    """Delete the temporary folder of a game without a save, if any."""
+    global world_folder
+    if world_folder is not None:
+        world_folder.cleanup()
+        world_folder = None
+
+
+def new_game(save_path=None, seed=None):
+    """Init GameObjects for new game state.
+
+    Levels left behind are kept beside save_path, or in memory if None.
+    The same seed always gives the same dungeon; None picks a random one.
+    """
+    global player, game_msgs, game_state, turn, rng, stats, scheduler
+    rng = RandomStreams(new_seed() if seed is None else seed)
+    stats = Counter()
+    scheduler = Scheduler()
     # Create player.
     fighter_component = Fighter(hp=30, defense=2, power=5,
                                 death_function=player_death)
     player = GameObject(0, 0, "@", "player",
                         colors.white, None, blocks=True,
                         fighter=fighter_component)
+    player.inventory = []
 
     # Generate map (not drawn).
+    reset_levels(save_path, clear=True)
     make_map()
     game_state = "playing"
+    turn = 0
 
     # Init player inv.
     item_component = Item(use_function=cast_teleporthome)
     beginscroll = GameObject(player.x, player.y, "#", "scroll of recall",
                              colors.cyan, item=item_component)
-    player.inventory = []
     player.inventory.append(beginscroll)
-    game_msgs = []
+    game_msgs = MessageLog(settings.message_history)
     message("Welcome to Umbrella. Arrow keys to move, g to pickup item, "
             "i for inventory, d for drop. glhf!", colors.amber)
 
 
-def play_game():
-    """Play game (main loop)."""
-    global mouse_coord, fov_recompute
+def play_game(save_path=SAVE_PATH, realtime=False):
+    """Play game (main loop); save_path None disables saving.
 
+    realtime plays on the wall clock with play_realtime. Headless games,
+    replays and bots leave it off, so they stay deterministic and run as
+    fast as they can.
+    """
+    init_render_state()
+    pregenerate_next()
+    if realtime:
+        play_realtime(save_path)
+    else:
+        play_turns(save_path)
+    autosaver.wait()
+    if save_path is None:
+        # Nothing is kept of a game without a save.
+        pregenerator.cancel()
+        remove_world_folder()
+
+
+def render_frame():
+    render_all()
+    with profiler.section("flush"):
+        backend.flush()
+    profiler.end_frame()
+
+
+def end_turn(save_path):
+    """Let the monsters act and the world catch up after the player."""
+    global turn
+    with profiler.section("ai"):
+        take_monster_turns()
+    populate_chunks(level)
+    turn += 1
+    if (save_path is not None and settings.autosave_turns and
+            turn % settings.autosave_turns == 0):
+        autosave(save_path)
+
+
+def play_turns(save_path):
+    """Turn-based main loop: the world waits for the player."""
     player_action = None
-    mouse_coord = (0, 0)
-    fov_recompute = True
-    con.clear()
-
-    while not tdl.event.is_window_closed():
-        render_all()
-        tdl.flush()
-        for obj in objects:
-            obj.clear()
-        player_action = handle_keys()
+    # Waits on input between events instead of redrawing every frame.
+    while not backend.is_closed():
+        if player_action != "idle":
+            render_frame()
+        with profiler.section("input"):
+            player_action = handle_keys()
         if player_action == "exit":
-            save_game()
+            if save_path is not None:
+                save_game(save_path)
             break
-        if game_state == "playing" and player_action != "didnt-take-turn":
-            for obj in objects:
-                if obj.ai:
-                    obj.ai.take_turn()
-
-
-def main_menu():
-    img = image_load("menu.png")
-    while not tdl.event.is_window_closed():
-        img.blit_2x(root, 0, 0)
+        if (game_state == "playing" and
+                player_action not in ("didnt-take-turn", "idle")):
+            end_turn(save_path)
+
+
+def play_realtime(save_path):
+    """Real-time main loop: the world moves on at TICK_RATE turns a second."""
+    global blocked
+    tick = 1 / TICK_RATE
+    frame = 1 / LIMIT_FPS if LIMIT_FPS else 0
+    events = deque()
+    acted = False
+    dirty = True
+    lag = 0.0
+    last = time.perf_counter()
+    while not backend.is_closed():
+        blocked = 0
+        with profiler.section("input"):
+            events.extend(backend.get_events())
+            while events and not acted:
+                player_action = handle_event(events.popleft())
+                if player_action == "exit":
+                    if save_path is not None:
+                        save_game(save_path)
+                    return
+                if player_action != "idle":
+                    dirty = True
+                acted = player_action not in ("didnt-take-turn", "idle")
+        if blocked:
+            # The game stood still while the player was in a menu.
+            last = time.perf_counter()
+        now = time.perf_counter()
+        lag += now - last
+        last = now
+        ticks = 0
+        while lag >= tick and ticks < MAX_FRAME_SKIP:
+            if game_state == "playing":
+                with profiler.tick():
+                    end_turn(save_path)
+                dirty = True
+            acted = False
+            lag -= tick
+            ticks += 1
+        if ticks == MAX_FRAME_SKIP:
+            lag = min(lag, tick)
+        if dirty:
+            render_frame()
+            dirty = False
+        # Sleep until the next tick is due, waking for input each frame.
+        pause = min(tick - lag, frame) - (time.perf_counter() - last)
+        if pause > 0:
+            with profiler.section(WAIT):
+                time.sleep(pause)
+
+
+def main_menu(seed=None, record_path=None):
+    """Show the main menu; record_path records new games for replay."""
+    while not backend.is_closed():
+        backend.blit_image("menu.png")
         choice = menu("", ["Play New", "Continue", "Quit"], 24)
         if choice == 0:
-            new_game()
-            play_game()
+            new_game(SAVE_PATH, seed)
+            if record_path is not None:
+                backend.start(rng.seed)
+            play_game(realtime=REALTIME)
+            if record_path is not None:
+                backend.save(record_path)
         elif choice == 1:
             try:
                 load_game()
@@ -853,17 +1752,93 @@ def main_menu():
                 msgbox("\nNo save game/file corruption.\n", 24)
                 time.sleep(4)
                 continue
-            play_game()
+            play_game(realtime=REALTIME)
         elif choice == 2:
             break
 
 
-tdl.set_font("dejavu10x10.png", greyscale=True, altLayout=True)
-root = tdl.init(SCREEN_WIDTH, SCREEN_HEIGHT, title="Umbrella",
-                fullscreen=False)
-tdl.setFPS(LIMIT_FPS)
-con = tdl.Console(MAP_WIDTH, MAP_HEIGHT)
-panel = tdl.Console(SCREEN_WIDTH, PANEL_HEIGHT)
-
-# Start game menu.
-main_menu()
+autosaver = savefile.Autosaver()
+# Map coords of the top left cell in view.
+camera_x = camera_y = 0
+rng = RandomStreams(0)
+# Store of the current level; new GameObjects go here unless told otherwise.
+entities = ecs.EntityStore()
+world_prefix = SAVE_PATH
+# tempfile.TemporaryDirectory holding world_prefix, for chunked games
+# without a save.
+world_folder = None
+player_flow = FlowField()
+profiler = Profiler(settings.profile_frames)
+# Blocking input reads, for play_realtime.
+blocked = 0
+scheduler = Scheduler()
+# Tallies of what happened this game, for simulate.py.
+stats = Counter()
+pregenerator = Pregenerator(generate_level)
+levels = LevelCache(settings.level_cache_size, snapshot_cached_level,
+                    decode_level)
+
+
+def init_backend(new_backend):
+    """Use new_backend for all drawing and input."""
+    global backend, root, con, panel
+    backend = new_backend
+    root = backend.root
+    con = backend.new_console(VIEW_WIDTH, VIEW_HEIGHT)
+    panel = backend.new_console(SCREEN_WIDTH, PANEL_HEIGHT)
+
+
+def run_replay(path):
+    """Replay the recording at path without a window; return turns played.
+
+    Nothing waits on the display, so the game runs as fast as it can.
+    """
+    seed, polls = replay.load(path)
+    init_backend(NullBackend(SCREEN_WIDTH, SCREEN_HEIGHT, polls=polls))
+    new_game(seed=seed)
+    play_game(save_path=None)
+    return turn
+
+
+def main():
+    global profiler, REALTIME
+    parser = argparse.ArgumentParser(description="Umbrella Rogue.")
+    parser.add_argument("--seed", type=int, help="seed for new games")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record new games to FILE for replay")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay FILE headlessly and print the time")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the timings of every frame to FILE")
+    parser.add_argument("--realtime", action="store_true",
+                        help="monsters act on a clock, not on your moves")
+    args = parser.parse_args()
+    if args.profile:
+        profiler = Profiler(settings.profile_frames, args.profile)
+    REALTIME = REALTIME or args.realtime
+    if REALTIME and args.record:
+        # Polls carry no tick boundaries, so only turn-based games replay.
+        parser.error("--record cannot be used in real-time mode")
+
+    if args.replay:
+        start = time.perf_counter()
+        turns = run_replay(args.replay)
+        elapsed = time.perf_counter() - start
+        print("{} turns in {:.3f}s ({:.1f} turns/s)".format(
+            turns, elapsed, turns / elapsed if elapsed else 0))
+        profiler.close()
+        return
+
+    # The real-time loop paces frames itself.
+    game_backend = TdlBackend(SCREEN_WIDTH, SCREEN_HEIGHT, "Umbrella",
+                              "dejavu10x10.png", 0 if REALTIME else LIMIT_FPS)
+    if args.record:
+        game_backend = replay.RecordingBackend(game_backend)
+    init_backend(game_backend)
+    # Start game menu.
+    main_menu(args.seed, args.record)
+    profiler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Message log for Umbrella Rogue.
+
+Messages are kept whole, up to a fixed number, in a ring buffer; the oldest
+drop off the end as new ones arrive. Wrapping to the panel width only
+happens when a message is about to be shown, and the wrapped lines are
+cached on the message, so adding a message does no wrapping.
+"""
+import textwrap
+from collections import deque
+from itertools import islice
+
+
+class MessageLog:
+    """Bounded history of (text, color) messages with a scrollback view."""
+    def __init__(self, capacity):
+        # Entries are [text, color, {width: wrapped lines}].
+        self._entries = deque(maxlen=capacity)
+        # Lines scrolled back from the newest; 0 shows the latest messages.
+        self.scroll = 0
+        # Set whenever what lines() returns may have changed.
+        self.dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        """Yield (text, color) of every message, oldest first."""
+        for (text, color, wrapped) in self._entries:
+            yield (text, color)
+
+    def add(self, text, color):
+        """Log a message and jump back to the newest messages."""
+        self._entries.append([text, color, {}])
+        self.scroll = 0
+        self.dirty = True
+
+    def scroll_by(self, lines, width, height):
+        """Scroll lines further back in history; negative goes forward.
+
+        Stops at either end of the history as wrapped to width and shown
+        height lines at a time.
+        """
+        wanted = max(0, self.scroll + lines)
+        available = sum(1 for line in islice(self._wrapped(width),
+                                             wanted + height))
+        scroll = max(0, min(wanted, available - height))
+        if scroll != self.scroll:
+            self.scroll = scroll
+            self.dirty = True
+
+    def _wrapped(self, width):
+        """Yield (line, color) wrapped to width, newest first."""
+        for entry in reversed(self._entries):
+            wrapped = entry[2].get(width)
+            if wrapped is None:
+                wrapped = entry[2][width] = textwrap.wrap(entry[0], width)
+            color = entry[1]
+            for line in reversed(wrapped):
+                yield (line, color)
+
+    def lines(self, width, height):
+        """Return up to height (line, color) pairs wrapped to width.
+
+        The lines are the ones in view at the current scroll position,
+        oldest first.
+        """
+        view = list(islice(self._wrapped(width), self.scroll,
+                           self.scroll + height))
+        view.reverse()
+        return view
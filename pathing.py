@@ -0,0 +1,184 @@
+"""Pathfinding for Umbrella Rogue.
+
+Instead of every monster working out its own route, one distance map
+(a Dijkstra map, or flow field) is built toward the goal and each monster
+just steps to whichever neighbouring tile is closest to it. Building the map
+is a breadth-first search run over whole frontiers at once with numpy, and
+one map serves every monster chasing the same goal. On big maps the field
+can be limited to a square around the goal; tiles outside it count as
+unreachable.
+"""
+import numpy as np
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+# All eight neighbours; moving diagonally costs one step like in the game.
+DIRECTIONS = ((-1, -1), (0, -1), (1, -1),
+              (-1, 0), (1, 0),
+              (-1, 1), (0, 1), (1, 1))
+# Up, down, left and right only, as the player moves.
+ORTHOGONAL = ((0, -1), (-1, 0), (1, 0), (0, 1))
+
+
+def distance_map(walkable, goal_x, goal_y, directions=DIRECTIONS):
+    """Return int32 array of steps from every tile to the goal.
+
+    walkable is a (width, height) boolean array; tiles that cannot reach the
+    goal hold UNREACHABLE. Steps go in any of directions.
+    """
+    width, height = walkable.shape
+    # A border of wall means neighbour offsets can never leave the array.
+    padded = np.zeros((width + 2, height + 2), dtype=bool, order="F")
+    padded[1:-1, 1:-1] = walkable
+    open_tiles = padded.ravel(order="F")
+    stride = width + 2
+    offsets = np.array([dx + dy * stride for (dx, dy) in directions])
+
+    dist = np.full(open_tiles.shape, UNREACHABLE, dtype=np.int32)
+    start = (goal_x + 1) + (goal_y + 1) * stride
+    dist[start] = 0
+    frontier = np.array([start])
+    step = 0
+    while frontier.size:
+        step += 1
+        around = (frontier[:, np.newaxis] + offsets).ravel()
+        around = around[open_tiles[around] & (dist[around] == UNREACHABLE)]
+        frontier = np.unique(around)
+        dist[frontier] = step
+    return dist.reshape(padded.shape, order="F")[1:-1, 1:-1]
+
+
+class FlowField:
+    """Distance map toward a goal, rebuilt only when goal or map change.
+
+    Movers step in any of directions, by default all eight.
+    """
+    def __init__(self, directions=DIRECTIONS):
+        self.directions = directions
+        self.distances = None
+        self._game_map = None
+        self._key = None
+        self.goal = None
+        # Map coords of distances[0, 0].
+        self.origin = (0, 0)
+
+    def update(self, game_map, goal_x, goal_y, radius=None):
+        """Point the field at goal on game_map; return the distance map.
+
+        With radius set only tiles within radius steps of the goal along
+        each axis are searched.
+        """
+        key = (game_map.version, goal_x, goal_y, radius)
+        if game_map is not self._game_map or key != self._key:
+            (x0, y0, x1, y1) = self._bounds(game_map, goal_x, goal_y, radius)
+            walkable = ~game_map.blocked[x0:x1, y0:y1]
+            self.distances = distance_map(walkable, goal_x - x0, goal_y - y0,
+                                          self.directions)
+            self.origin = (x0, y0)
+            self._game_map = game_map
+            self._key = key
+            self.goal = (goal_x, goal_y)
+        return self.distances
+
+    def _bounds(self, game_map, x, y, radius):
+        if radius is None:
+            return (0, 0, game_map.width, game_map.height)
+        return (max(0, x - radius), max(0, y - radius),
+                min(game_map.width, x + radius + 1),
+                min(game_map.height, y + radius + 1))
+
+    def window(self):
+        """Return the (x, y) slices of the map the field covers."""
+        (x0, y0) = self.origin
+        (width, height) = self.distances.shape
+        return (slice(x0, x0 + width), slice(y0, y0 + height))
+
+    def distance(self, x, y):
+        """Return steps from coords (scalars or arrays) to the goal."""
+        (x0, y0) = self.origin
+        x = np.asarray(x) - x0
+        y = np.asarray(y) - y0
+        (width, height) = self.distances.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        dist = np.where(inside, self.distances[np.where(inside, x, 0),
+                                               np.where(inside, y, 0)],
+                        UNREACHABLE)
+        return dist if dist.ndim else int(dist)
+
+    def reachable(self, x, y):
+        """Return True if coords have a path to the goal."""
+        return self.distance(x, y) != UNREACHABLE
+
+    def step(self, x, y, blocked):
+        """Return (dx, dy) of the best step downhill from coords, or None.
+
+        blocked(x, y) rules out tiles taken by other objects. Among equally
+        short routes the step ending nearest the goal in a straight line wins,
+        which keeps movement looking direct in open rooms.
+        """
+        here = self.distance(x, y)
+        (goal_x, goal_y) = self.goal
+        best = None
+        best_key = None
+        for (dx, dy) in self.directions:
+            nx = x + dx
+            ny = y + dy
+            dist = self.distance(nx, ny)
+            if dist >= here:
+                continue
+            key = (dist, (goal_x - nx) ** 2 + (goal_y - ny) ** 2)
+            if best_key is not None and key >= best_key:
+                continue
+            if blocked(nx, ny):
+                continue
+            best = (dx, dy)
+            best_key = key
+        return best
+
+    def steps(self, xs, ys, occupied):
+        """Step many movers downhill at once.
+
+        xs and ys are arrays of mover coords, all reachable, and occupied a
+        boolean array of tiles they may not enter, covering window() of the
+        map. Returns (new_xs, new_ys, moved). A mover
+        stays put if no free neighbour is closer to the goal, or if an
+        earlier mover in the arrays claimed the same tile this round. Ties
+        are broken as in step().
+        """
+        width, height = self.distances.shape
+        (x0, y0) = self.origin
+        count = xs.size
+        rows = np.arange(count)
+        directions = np.array(self.directions)
+        # Work in window coords, shifting back at the end.
+        xs = xs - x0
+        ys = ys - y0
+        nx = xs[:, np.newaxis] + directions[:, 0]
+        ny = ys[:, np.newaxis] + directions[:, 1]
+        inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+        cx = np.clip(nx, 0, width - 1)
+        cy = np.clip(ny, 0, height - 1)
+        dist = self.distances[cx, cy].astype(np.int64)
+        here = self.distances[xs, ys][:, np.newaxis]
+        free = inside & (dist < here) & ~occupied[cx, cy]
+
+        goal_x = self.goal[0] - x0
+        goal_y = self.goal[1] - y0
+        # Step count first, straight-line distance only to break ties.
+        scale = width * width + height * height + 1
+        key = dist * scale + (goal_x - nx) ** 2 + (goal_y - ny) ** 2
+        key[~free] = np.iinfo(np.int64).max
+        choice = key.argmin(axis=1)
+        can_move = free[rows, choice]
+        new_xs = np.where(can_move, nx[rows, choice], xs)
+        new_ys = np.where(can_move, ny[rows, choice], ys)
+
+        # Two movers after the same tile: the first one gets it.
+        movers = np.flatnonzero(can_move)
+        targets = new_xs[movers] + new_ys[movers] * width
+        _, first = np.unique(targets, return_index=True)
+        moved = np.zeros(count, dtype=bool)
+        moved[movers[first]] = True
+        new_xs = np.where(moved, new_xs, xs) + x0
+        new_ys = np.where(moved, new_ys, ys) + y0
+        return new_xs, new_ys, moved
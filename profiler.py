@@ -0,0 +1,140 @@
+"""Frame profiling for Umbrella Rogue.
+
+The main loop times its parts (input handling, FOV, map and object drawing,
+the panel, the AI pass, flushing to screen) in named sections, and calls
+end_frame() once per frame. Section times are exclusive: a section nested
+in another is not counted in the outer one too. Time in the WAIT section,
+blocked on the player, is kept but left out of the frame time.
+
+In real-time mode the simulation ticks on its own clock, so a frame may
+hold several ticks or none. Each tick is timed whole, and tick times are
+reported apart from frame times: a frame's time leaves out its ticks, as
+it leaves out WAIT. The sections of a tick, such as the AI pass, are still
+listed with the frame they ran in.
+
+The last window frames of each section are kept for rolling p50/p95/p99
+figures, and every frame can be written out as one line of JSON to a trace
+file for closer study.
+"""
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Section for time spent waiting on input.
+WAIT = "wait"
+# Samples of whole simulation ticks.
+TICK = "tick"
+
+
+class Profiler:
+    """Per-frame section timer with rolling percentiles."""
+    def __init__(self, window=300, trace_path=None):
+        self.window = window
+        # Set to show the overlay in the panel.
+        self.overlay = False
+        self.frames = 0
+        self.ticks = 0
+        self._samples = {"frame": deque(maxlen=window),
+                         TICK: deque(maxlen=window)}
+        self._frame = {}
+        # Times of the ticks in this frame.
+        self._frame_ticks = []
+        self._stack = []
+        self._since = self._frame_start = time.perf_counter()
+        self._trace = open(trace_path, "w") if trace_path else None
+
+    def start(self, name):
+        """Start timing section name, pausing the section it is inside."""
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self._frame[outer] = self._frame.get(outer, 0) + now - self._since
+        self._stack.append(name)
+        self._since = now
+
+    def stop(self):
+        """Stop timing the innermost section."""
+        now = time.perf_counter()
+        name = self._stack.pop()
+        self._frame[name] = self._frame.get(name, 0) + now - self._since
+        self._since = now
+
+    @contextmanager
+    def section(self, name):
+        """Time the body of a with statement as section name."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    @contextmanager
+    def tick(self):
+        """Time the body of a with statement as one simulation tick."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._samples[TICK].append(elapsed)
+            self._frame_ticks.append(elapsed)
+            self.ticks += 1
+
+    def end_frame(self):
+        """Record the frame since the last call and start a new one."""
+        now = time.perf_counter()
+        frame = (now - self._frame_start - self._frame.get(WAIT, 0) -
+                 sum(self._frame_ticks))
+        self._frame_start = now
+        self._samples["frame"].append(frame)
+        for name, samples in self._samples.items():
+            if name not in ("frame", TICK):
+                samples.append(self._frame.get(name, 0))
+        for name, elapsed in self._frame.items():
+            if name not in self._samples:
+                self._samples[name] = deque([elapsed], maxlen=self.window)
+        if self._trace is not None:
+            self._trace.write(json.dumps({"frame": self.frames,
+                                          "time": frame,
+                                          "sections": self._frame,
+                                          "ticks": self._frame_ticks}) + "\n")
+        self.frames += 1
+        self._frame = {}
+        self._frame_ticks = []
+
+    def percentiles(self, name="frame"):
+        """Return (p50, p95, p99) in seconds of section name over window."""
+        samples = self._samples.get(name)
+        if not samples:
+            return (0.0, 0.0, 0.0)
+        return tuple(np.percentile(samples, (50, 95, 99)).tolist())
+
+    def top(self, n):
+        """Return the n costliest sections by p95, as (name, p50, p95, p99)."""
+        costs = [(name,) + self.percentiles(name) for name in self._samples
+                 if name not in ("frame", TICK, WAIT)]
+        costs.sort(key=lambda cost: cost[2], reverse=True)
+        return costs[:n]
+
+    def report(self, lines):
+        """Return up to lines lines of text summing up recent frames."""
+        (p50, p95, p99) = self.percentiles()
+        text = ["frame ms p50 {:.2f} p95 {:.2f} p99 {:.2f}".format(
+            p50 * 1000, p95 * 1000, p99 * 1000)]
+        if self._samples[TICK]:
+            (p50, p95, p99) = self.percentiles(TICK)
+            text.append("tick ms  p50 {:.2f} p95 {:.2f} p99 {:.2f}".format(
+                p50 * 1000, p95 * 1000, p99 * 1000))
+        for (name, p50, p95, p99) in self.top(lines - len(text)):
+            text.append("{:<8} p50 {:.2f} p95 {:.2f} p99 {:.2f}".format(
+                name, p50 * 1000, p95 * 1000, p99 * 1000))
+        return text
+
+    def close(self):
+        """Finish the trace file, if any."""
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
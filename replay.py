@@ -0,0 +1,92 @@
+"""Input recording and replay for Umbrella Rogue.
+
+RecordingBackend wraps a backend and logs every input event the game
+consumes, poll by poll. A recording is that log plus the game seed, saved as
+JSON; feeding it back through a NullBackend replays the game exactly, as
+fast as the CPU allows. That makes recordings a repeatable workload for
+performance comparisons between builds.
+"""
+import json
+
+from backends import Event
+
+# Version 2: events handled one at a time, as taken by wait_event.
+FORMAT_VERSION = 2
+EVENT_FIELDS = ("type", "key", "char", "text", "control", "cell", "button")
+
+
+def event_to_dict(event):
+    """Return the fields of a tdl or backends.Event event as a dict."""
+    fields = {}
+    for field in EVENT_FIELDS:
+        value = getattr(event, field, None)
+        if value is not None:
+            fields[field] = list(value) if field == "cell" else value
+    return fields
+
+
+def event_from_dict(fields):
+    """Return backends.Event made from an event_to_dict dict."""
+    fields = dict(fields)
+    if "cell" in fields:
+        fields["cell"] = tuple(fields["cell"])
+    return Event(**fields)
+
+
+class RecordingBackend:
+    """Backend passing everything to backend, logging the input it returns.
+
+    Polls that return no events are not logged; they cannot change the game.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self.root = backend.root
+        self.seed = None
+        self.polls = []
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def start(self, seed):
+        """Throw away anything recorded so far and record a game of seed."""
+        self.seed = seed
+        self.polls = []
+
+    def get_events(self):
+        events = list(self._backend.get_events())
+        if events:
+            self.polls.append([event_to_dict(event) for event in events])
+        return events
+
+    def wait_event(self):
+        event = self._backend.wait_event()
+        if event is not None:
+            self.polls.append([event_to_dict(event)])
+        return event
+
+    def wait_key(self):
+        event = self._backend.wait_key()
+        self.polls.append([event_to_dict(event)])
+        return event
+
+    def save(self, path):
+        """Write the recording to path."""
+        with open(path, "w") as f:
+            json.dump({"version": FORMAT_VERSION, "seed": self.seed,
+                       "polls": self.polls}, f)
+
+
+def load(path):
+    """Return (seed, polls) of the recording at path.
+
+    polls is a list of lists of backends.Event, one list per poll, ready
+    to hand to backends.NullBackend.
+    """
+    with open(path) as f:
+        recording = json.load(f)
+    if recording.get("version") != FORMAT_VERSION:
+        raise ValueError("Unsupported recording version {}."
+                         .format(recording.get("version")))
+    polls = [[event_from_dict(fields) for fields in poll]
+             for poll in recording["polls"]]
+    return recording["seed"], polls
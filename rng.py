@@ -0,0 +1,37 @@
+"""Seeded random number streams for Umbrella Rogue.
+
+Every game has one seed. Each subsystem draws from its own stream derived
+from it, so e.g. a monster stumbling about confused never changes what the
+next level looks like. Map generation and spawning get a fresh stream per
+level, which keeps levels identical whichever order (or thread) they are
+generated in.
+"""
+import random
+
+# Subsystems with their own stream.
+STREAMS = ("map", "spawn", "ai")
+
+
+def new_seed():
+    """Return a seed for a new game."""
+    return random.SystemRandom().getrandbits(32)
+
+
+class RandomStreams:
+    """Independent random.Random streams derived from one game seed."""
+    def __init__(self, seed, turn=0):
+        self.seed = seed
+        # The AI stream runs for the whole game; restarting it from the turn
+        # keeps a loaded game deterministic without saving its state.
+        self.ai = self.stream("ai", turn)
+
+    def stream(self, name, n=0):
+        """Return a new random.Random for stream name, number n.
+
+        Levels use their depth as n.
+        """
+        if name not in STREAMS:
+            raise ValueError("Unknown random stream {!r}.".format(name))
+        # String seeds are hashed with SHA-512, so they are stable across
+        # runs and Python versions.
+        return random.Random("{}:{}:{}".format(self.seed, name, n))
@@ -0,0 +1,277 @@
+"""Binary save format for Umbrella Rogue.
+
+A save is a small header followed by sections, each starting on an 8 byte
+boundary so it can be read straight out of a memory map:
+
+    header    magic, format version and the size of every section
+    strings   interned names (object names, function names, messages...)
+    meta      (string id, int64) pairs: game state, player index...
+    layers    map tile layers, bit-packed, in [x, y] Fortran order
+    objects   fixed-width OBJECT_DTYPE records
+    messages  fixed-width MESSAGE_DTYPE records
+
+Records refer to strings by their id in the string table, so names and the
+functions an object uses are stored once.
+This module knows nothing about the game classes; main.py turns objects into
+records and back.
+
+Files are written to a temporary file, fsynced and renamed into place, so a
+crash part way through a save never leaves a broken file behind. Autosaver
+does that on a background thread.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+MAGIC = b"UMBR"
+# Version 2: objects have a speed.
+VERSION = 2
+HEADER = struct.Struct("<4sHHIIIIIII")
+ALIGN = 8
+
+# Object record flags.
+BLOCKS = 1
+FIGHTER = 2
+ITEM = 4
+IN_INVENTORY = 8
+STAIRS_DOWN = 16
+STAIRS_UP = 32
+
+# String fields hold ids into the string table; id 0 is always "".
+OBJECT_DTYPE = np.dtype([
+    ("x", "<i4"), ("y", "<i4"),
+    ("char", "<u4"),
+    ("r", "u1"), ("g", "u1"), ("b", "u1"),
+    ("flags", "u1"),
+    ("name", "<u4"),
+    ("ai", "<u4"), ("old_ai", "<u4"), ("ai_turns", "<i4"),
+    ("hp", "<i4"), ("max_hp", "<i4"), ("defense", "<i4"), ("power", "<i4"),
+    ("death", "<u4"),
+    ("use", "<u4"),
+    ("speed", "<i4"),
+])
+MESSAGE_DTYPE = np.dtype([
+    ("text", "<u4"),
+    ("r", "u1"), ("g", "u1"), ("b", "u1"),
+])
+META_DTYPE = np.dtype([("key", "<u4"), ("value", "<i8")])
+
+
+class StringTable:
+    """Interns strings, giving each a small integer id."""
+    def __init__(self, strings=("",)):
+        self.strings = list(strings)
+        self.ids = {s: i for i, s in enumerate(self.strings)}
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        """Return id of string, adding it to the table if new."""
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+
+def _padding(size):
+    return -size % ALIGN
+
+
+def _packed_size(width, height):
+    return (width * height + 7) // 8
+
+
+def dumps(width, height, layers, objects, messages, strings, meta):
+    """Return the bytes of a save file.
+
+    layers maps layer name to a (width, height) boolean array; objects and
+    messages are OBJECT_DTYPE and MESSAGE_DTYPE arrays whose string fields
+    index strings; meta maps names to ints.
+    """
+    names = np.array([strings.intern(name) for name in layers], dtype="<u4")
+    meta_records = np.array([(strings.intern(key), value)
+                             for key, value in meta.items()],
+                            dtype=META_DTYPE)
+    encoded = [s.encode("utf-8") for s in strings.strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    chunks = [HEADER.pack(MAGIC, VERSION, 0, width, height, len(strings),
+                          len(meta_records), len(layers), len(objects),
+                          len(messages))]
+    chunks.append(offsets.tobytes() + b"".join(encoded))
+    chunks.append(meta_records.tobytes())
+    chunks.append(names.tobytes())
+    for layer in layers.values():
+        chunks.append(np.packbits(layer.ravel(order="F")).tobytes())
+    chunks.append(np.ascontiguousarray(objects, dtype=OBJECT_DTYPE).tobytes())
+    chunks.append(np.ascontiguousarray(messages,
+                                       dtype=MESSAGE_DTYPE).tobytes())
+    return b"".join(chunk + b"\0" * _padding(len(chunk)) for chunk in chunks)
+
+
+def write(path, *snapshot):
+    """Write a save file; takes the same arguments as dumps after path."""
+    write_bytes(path, dumps(*snapshot))
+
+
+def write_bytes(path, data):
+    """Atomically replace the file at path with data."""
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _fsync_dir(folder)
+
+
+def _fsync_dir(folder):
+    """Make a rename in folder durable, where the OS allows it."""
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Autosaver:
+    """Writes saves on a background thread.
+
+    The caller takes the snapshot (the arguments to write) on the main
+    thread; only encoding, writing and fsyncing happen on the worker. A save
+    requested while one is still running is skipped.
+    """
+    def __init__(self):
+        self._thread = None
+        self.error = None
+
+    def busy(self):
+        """Return True if a save is still being written."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def save(self, path, snapshot, before=None):
+        """Start writing snapshot to path; return False if skipped.
+
+        before, if given, is called on the worker first, e.g. to write
+        files the save refers to.
+        """
+        if self.busy():
+            return False
+        self._thread = threading.Thread(target=self._write,
+                                        args=(path, snapshot, before),
+                                        daemon=True)
+        self._thread.start()
+        return True
+
+    def _write(self, path, snapshot, before):
+        try:
+            if before is not None:
+                before()
+            write(path, *snapshot)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Block until any running save has finished."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class SaveReader:
+    """Memory-mapped view of a save file.
+
+    Use as a context manager. Arrays handed out are views onto the map and
+    must be copied if kept after the file is closed. path may also be the
+    bytes of a save, e.g. one that was decompressed in memory.
+    """
+    def __init__(self, path):
+        if isinstance(path, (bytes, bytearray)):
+            self._mm = path
+            path = "<bytes>"
+        else:
+            with open(path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        (magic, version, _, self.width, self.height, n_strings, n_meta,
+         n_layers, n_objects, n_messages) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a save file.".format(path))
+        if version != VERSION:
+            raise ValueError("Unsupported save version {}.".format(version))
+        offset = HEADER.size + _padding(HEADER.size)
+
+        offsets = self._array("<u4", n_strings + 1, offset)
+        blob = offset + offsets.nbytes
+        self.strings = StringTable(
+            bytes(self._mm[blob + start:blob + end]).decode("utf-8")
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()))
+        offset = self._next(blob + int(offsets[-1]))
+
+        meta = self._array(META_DTYPE, n_meta, offset)
+        self.meta = {self.strings[key]: value
+                     for key, value in meta.tolist()}
+        offset = self._next(offset + meta.nbytes)
+
+        names = self._array("<u4", n_layers, offset)
+        offset = self._next(offset + names.nbytes)
+        self._layers = {}
+        size = _packed_size(self.width, self.height)
+        for name in names.tolist():
+            self._layers[self.strings[name]] = offset
+            offset = self._next(offset + size)
+
+        self.objects = self._array(OBJECT_DTYPE, n_objects, offset)
+        offset = self._next(offset + self.objects.nbytes)
+        self.messages = self._array(MESSAGE_DTYPE, n_messages, offset)
+
+    def _array(self, dtype, count, offset):
+        return np.frombuffer(self._mm, dtype=dtype, count=count,
+                             offset=offset)
+
+    def _next(self, offset):
+        return offset + _padding(offset)
+
+    def layer(self, name):
+        """Return layer as a new (width, height) boolean array."""
+        packed = self._array("u1", _packed_size(self.width, self.height),
+                             self._layers[name])
+        bits = np.unpackbits(packed, count=self.width * self.height)
+        return bits.reshape((self.width, self.height), order="F").astype(bool)
+
+    def close(self):
+        self.objects = self.messages = None
+        if not isinstance(self._mm, mmap.mmap):
+            return
+        try:
+            self._mm.close()
+        except BufferError:
+            # A caller still holds a view; the map is freed along with it.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,79 @@
+"""Turn scheduling for Umbrella Rogue.
+
+Game time is counted in ticks; an action at NORMAL_SPEED takes TURN ticks,
+twice as fast takes half as long. Actors and timed effects wait in a heap
+keyed by when they are next due, so each round only pops what is actually
+due instead of polling every monster and every countdown. At equal speeds
+everything due acts once per player turn, in the same order as always.
+
+Actors are taken off the schedule lazily: unschedule() just forgets the
+live entry, and stale heap entries are skipped when they come up.
+"""
+import heapq
+from itertools import count
+
+# Ticks an action takes at NORMAL_SPEED.
+TURN = 100
+NORMAL_SPEED = 100
+
+# Effects come before actors due at the same time.
+EFFECT = 0
+ACTOR = 1
+
+
+def delay(speed):
+    """Return ticks between the actions of an actor of speed."""
+    return TURN * NORMAL_SPEED // max(1, speed)
+
+
+class Scheduler:
+    """Priority queue of actors and effects by the tick they are due."""
+    def __init__(self, time=0):
+        # The current tick: when the player acts.
+        self.time = time
+        self._heap = []
+        self._seq = count()
+        # Seq of the live heap entry of every scheduled actor.
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, actor):
+        return actor in self._entries
+
+    def schedule(self, actor, time):
+        """Have actor act at tick time, replacing any earlier entry."""
+        seq = next(self._seq)
+        self._entries[actor] = seq
+        heapq.heappush(self._heap, (time, ACTOR, seq, actor))
+
+    def unschedule(self, actor):
+        """Take actor off the schedule."""
+        self._entries.pop(actor, None)
+
+    def add_effect(self, time, effect):
+        """Call effect() once tick time comes."""
+        heapq.heappush(self._heap, (time, EFFECT, next(self._seq), effect))
+
+    def pop(self, until):
+        """Take everything due at the earliest tick no later than until.
+
+        Returns (tick, effects, actors), or None if nothing is due. Actors
+        returned are off the schedule until scheduled again.
+        """
+        heap = self._heap
+        while heap and heap[0][0] <= until:
+            when = heap[0][0]
+            effects = []
+            actors = []
+            while heap and heap[0][0] == when:
+                (when, kind, seq, item) = heapq.heappop(heap)
+                if kind == EFFECT:
+                    effects.append(item)
+                elif self._entries.get(item) == seq:
+                    del self._entries[item]
+                    actors.append(item)
+            if effects or actors:
+                return (when, effects, actors)
+        return None
@@ -16,6 +16,16 @@ fps = 60
 bar_width = 20
 panel_height = 7
 inventory_width = 50
+# Messages kept for scrolling back through with Page Up/Page Down.
+message_history = 500
+# Frames the profiler overlay (F3) takes its percentiles over.
+profile_frames = 300
+# Real-time mode (also main.py --realtime): monsters act tick_rate times a
+# second whether or not the player moves. A slow frame makes up at most
+# max_frame_skip missed ticks before drawing again.
+realtime = False
+tick_rate = 10
+max_frame_skip = 5
 
 """Dungeon Generation."""
 room_min_size = 6
@@ -23,11 +33,30 @@ room_max_size = 10
 max_rooms = 30
 max_room_monsters = 3
 max_room_items = 2
+# "random" scatters rooms like the original generator; "bsp" partitions the
+# map and scales to very large maps with thousands of rooms.
+dungeon_generator = "random"
+# "flat" keeps the whole map in memory; "chunked" makes it in chunk_size
+# square chunks as the player nears them, holding at most chunk_cache_size
+# in memory and the rest in a file beside the save. Chunked levels place
+# chunk_rooms rooms per chunk and look for paths within flow_radius tiles.
+world = "flat"
+chunk_size = 64
+chunk_cache_size = 64
+chunk_rooms = 6
+flow_radius = 30
+# Monsters further than this from the player sleep until the player comes
+# near.
+wake_radius = 15
+# Visited levels kept in memory; older ones are compressed to disk.
+level_cache_size = 3
 
 """FOV settings."""
 fov_algo = "BASIC"
 fov_light_walls = True
 torch_radius = 10
+# FOV results kept per map, for when the player comes back to a spot.
+fov_cache_size = 64
 
 """Spells quantities."""
 heal_amount = 4
@@ -38,3 +67,7 @@ confuse_range = 8
 fireball_radius = 3
 fireball_damage = 12
 teleport_range = 6
+
+"""Saving."""
+# Save in the background every this many turns; 0 turns it off.
+autosave_turns = 50
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Batch simulation of Umbrella Rogue games played by a bot.
+
+Plays many complete games headlessly, one seed each, over a pool of worker
+processes, and sums up how they went: turns survived, depth reached, damage
+taken, items used and kills. Games are independent, so throughput grows
+with the number of cores. Setting overrides apply to every game, which makes
+it quick to see what a change to settings.py does to the game.
+
+    python3 simulate.py --games 1000                     # every core
+    python3 simulate.py --policy random --processes 2
+    python3 simulate.py --set heal_amount=8 --set max_room_monsters=5
+    python3 simulate.py --games 500 --json sim_output.json
+
+The bot plays through a NullBackend whose input is a generator: each event
+is worked out from the game state at the moment the game asks for input.
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import time
+
+import numpy as np
+
+import ecs
+import settings
+from backends import NullBackend, keydown, mousedown
+from pathing import FlowField, ORTHOGONAL
+
+# Per-game figures, in report order.
+FIELDS = ("turns", "depth", "damage_taken", "items_used", "kills", "died")
+ARROWS = {(0, -1): "UP", (0, 1): "DOWN", (-1, 0): "LEFT", (1, 0): "RIGHT"}
+# Heal below this fraction of max hp.
+HEAL_BELOW = 0.4
+# Tiles beyond the player the bot looks for a way round obstacles.
+DETOUR = 10
+
+# The game module, imported by init_worker once settings are overridden.
+main = None
+
+
+def init_worker(overrides):
+    """Apply setting overrides, then load the game, in a worker process."""
+    global main
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    import main as game
+    main = game
+
+
+def use_item(name, target=None):
+    """Yield the input using the first item called name; True if carried.
+
+    Spells that ask for a target are aimed at map coords target. A right
+    click follows, cancelling the spell if the target was refused; the main
+    loop ignores it otherwise.
+    """
+    for i, obj in enumerate(main.player.inventory):
+        if obj.name == name:
+            yield keydown(text="i")
+            yield keydown(text=chr(ord("a") + i))
+            if target is not None:
+                cell = (target[0] - main.camera_x, target[1] - main.camera_y)
+                yield mousedown(cell)
+                yield mousedown(cell, "RIGHT")
+            return True
+    return False
+
+
+def has_item(name):
+    return any(obj.name == name for obj in main.player.inventory)
+
+
+def visible_entities(flag=0, ai=False):
+    """Return handles of visible entities on the map with flag or an AI."""
+    store = main.entities
+    if ai:
+        ids = np.flatnonzero(store.ai_kind[:store.size])
+    else:
+        ids = np.flatnonzero(store.flags[:store.size] & flag)
+    ids = ids[main.visible[store.x[ids].astype(np.intp),
+                           store.y[ids].astype(np.intp)]]
+    return [store.handle[entity] for entity in ids.tolist()
+            if store.handle[entity] in main.object_index]
+
+
+class Bot:
+    """What a policy keeps between moves."""
+    def __init__(self, seed):
+        self.flow = FlowField(ORTHOGONAL)
+        self.rand = random.Random(seed)
+        # Object last headed for; followed even once out of sight, so the
+        # bot does not dither at the edge of its view.
+        self.target = None
+
+    def random_step(self):
+        return keydown(self.rand.choice(list(ARROWS.values())))
+
+
+def step_towards(flow, goal):
+    """Return arrow key of the step toward goal, or None if out of reach."""
+    player = main.player
+    # Search no more than DETOUR tiles further out than the goal.
+    radius = max(abs(goal[0] - player.x), abs(goal[1] - player.y)) + DETOUR
+    if main.FLOW_RADIUS is not None:
+        radius = min(radius, main.FLOW_RADIUS)
+    flow.update(main.my_map, goal[0], goal[1], radius)
+    # Monsters in the way are attacked by walking into them.
+    step = flow.step(player.x, player.y, lambda x, y: False)
+    return None if step is None else ARROWS[step]
+
+
+def random_policy(bot):
+    """Wander at random, picking up whatever is underfoot."""
+    player = main.player
+    if len(player.inventory) < 26 and any(
+            obj.item for obj in main.object_index.at(player.x, player.y)):
+        yield keydown(text="g")
+    else:
+        yield bot.random_step()
+
+
+def fighter_policy(bot):
+    """Fight whatever is in sight, collect items, then head downstairs.
+
+    Drinks healing potions when hurt, throws fireballs at groups out of
+    the blast's reach and uses lightning on monsters too tough to finish in
+    one blow.
+    """
+    player = main.player
+    fighter = player.fighter
+    if fighter.hp < fighter.max_hp * HEAL_BELOW:
+        if (yield from use_item("healing potion")):
+            return
+    targets = []
+    monsters = visible_entities(ai=True)
+    if monsters:
+        target = min(monsters, key=player.distance_to)
+        distance = player.distance_to(target)
+        targets.append(target)
+        goal = (target.x, target.y)
+        group = [monster for monster in monsters
+                 if target.distance_to(monster) <= settings.fireball_radius]
+        if (len(group) > 1 and has_item("scroll of fireball") and
+                distance > settings.fireball_radius + 1):
+            yield from use_item("scroll of fireball", goal)
+            return
+        if (has_item("scroll of lightning") and
+                distance <= settings.lightning_range and
+                target.fighter.hp > fighter.power):
+            yield from use_item("scroll of lightning", goal)
+            return
+    here = main.object_index.at(player.x, player.y)
+    if len(player.inventory) < 26 and any(obj.item for obj in here):
+        yield keydown(text="g")
+        return
+    if any(obj.stairs > 0 for obj in here):
+        yield keydown(text=">")
+        return
+    items = visible_entities(ecs.ITEM)
+    if items:
+        targets.append(min(items, key=player.distance_to))
+    if (bot.target in main.object_index and
+            (bot.target.ai or bot.target.item)):
+        targets.append(bot.target)
+    goals = [(target, (target.x, target.y)) for target in targets]
+    if main.level.stairs.get(1) is not None:
+        goals.append((None, main.level.stairs[1]))
+    # Whatever is out of reach is passed over for the next goal.
+    for (target, goal) in goals:
+        key = step_towards(bot.flow, goal)
+        if key is not None:
+            bot.target = target
+            yield keydown(key)
+            return
+    yield bot.random_step()
+
+
+POLICIES = {"fighter": fighter_policy, "random": random_policy}
+
+
+def bot_events(policy, max_turns, seed):
+    """Yield the input of policy playing the current game to its end.
+
+    Quits once the player dies or max_turns turns have passed, or after
+    many actions that took no turn, so a stuck bot cannot hang the run.
+    """
+    bot = Bot(seed)
+    actions = 0
+    while (main.game_state == "playing" and main.turn < max_turns and
+           actions < max_turns * 4):
+        yield from policy(bot)
+        actions += 1
+    yield keydown("ESCAPE")
+
+
+def play(job):
+    """Play one game; return its figures as a dict of FIELDS."""
+    (seed, policy, max_turns) = job
+    events = bot_events(POLICIES[policy], max_turns, seed)
+    main.init_backend(NullBackend(main.SCREEN_WIDTH, main.SCREEN_HEIGHT,
+                                  events))
+    main.new_game(seed=seed)
+    main.play_game(save_path=None)
+    return {"seed": seed,
+            "turns": main.turn,
+            "depth": main.level.depth,
+            "damage_taken": main.stats["damage_taken"],
+            "items_used": main.stats["items_used"],
+            "kills": main.stats["kills"],
+            "died": int(main.game_state == "dead")}
+
+
+def summarise(games):
+    """Return {field: {mean, median, min, max, total}} over games."""
+    summary = {}
+    for field in FIELDS:
+        values = [game[field] for game in games]
+        summary[field] = {"mean": statistics.mean(values),
+                          "median": statistics.median(values),
+                          "min": min(values),
+                          "max": max(values),
+                          "total": sum(values)}
+    return summary
+
+
+def parse_override(text):
+    """Return (name, value) of a NAME=VALUE setting override."""
+    (name, _, value) = text.partition("=")
+    if not hasattr(settings, name):
+        raise argparse.ArgumentTypeError("no setting {!r}".format(name))
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        # Bare words, e.g. world=chunked, are strings.
+        pass
+    return (name, value)
+
+
+def main_simulate():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game; the rest follow on")
+    parser.add_argument("--policy", choices=sorted(POLICIES),
+                        default="fighter")
+    parser.add_argument("--max-turns", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--set", type=parse_override, action="append",
+                        default=[], metavar="NAME=VALUE",
+                        help="override a value of settings.py")
+    parser.add_argument("--json", help="write every game's figures here")
+    args = parser.parse_args()
+
+    overrides = dict(args.set)
+    jobs = [(seed, args.policy, args.max_turns)
+            for seed in range(args.seed, args.seed + args.games)]
+    # Small batches keep every worker busy to the end.
+    chunksize = max(1, args.games // (args.processes * 8))
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes, init_worker,
+                              (overrides,)) as pool:
+        games = list(pool.imap_unordered(play, jobs, chunksize))
+    elapsed = time.perf_counter() - start
+    games.sort(key=lambda game: game["seed"])
+
+    summary = summarise(games)
+    print("{} games in {:.2f}s on {} processes ({:.1f} games/s)".format(
+        len(games), elapsed, args.processes, len(games) / elapsed))
+    for field in FIELDS:
+        s = summary[field]
+        print("{:<13} mean {:>9.2f} median {:>8} min {:>6} max {:>6} "
+              "total {:>8}".format(field, s["mean"], s["median"], s["min"],
+                                   s["max"], s["total"]))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"policy": args.policy, "max_turns": args.max_turns,
+                       "settings": overrides, "seconds": elapsed,
+                       "summary": summary, "games": games}, out, indent=1)
+
+
+if __name__ == "__main__":
+    main_simulate()
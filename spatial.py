@@ -0,0 +1,106 @@
+"""Spatial index for game objects.
+
+Objects are filed under the cell they stand on, so "what is at (x, y)" and
+"what is within r of (x, y)" only look at the cells involved instead of
+scanning every object on the level. The index only stores positions; flags
+such as blocks or fighter are read from the objects when queried, so deaths
+and status changes need no bookkeeping.
+
+Every cell an object is added to, removed from or moves between is recorded
+until pop_changed() is called, which lets the renderer redraw only those
+cells.
+"""
+import math
+
+
+class SpatialIndex:
+    """Hash of map cells to the objects standing on them."""
+    def __init__(self, objects=()):
+        self._cells = {}
+        self._positions = {}
+        self._changed = set()
+        for obj in objects:
+            self.add(obj)
+
+    def __contains__(self, obj):
+        return obj in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, obj):
+        """Start tracking obj at its current position."""
+        pos = (obj.x, obj.y)
+        self._positions[obj] = pos
+        self._cells.setdefault(pos, []).append(obj)
+        self._changed.add(pos)
+
+    def remove(self, obj):
+        """Stop tracking obj."""
+        pos = self._positions.pop(obj)
+        cell = self._cells[pos]
+        cell.remove(obj)
+        if not cell:
+            del self._cells[pos]
+        self._changed.add(pos)
+
+    def update(self, obj):
+        """Move obj to the cell it now stands on, if it is tracked."""
+        old = self._positions.get(obj)
+        new = (obj.x, obj.y)
+        if old is None or old == new:
+            return
+        self.remove(obj)
+        self.add(obj)
+
+    def pop_changed(self):
+        """Return set of cells changed since last call, and reset it."""
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def blocking_in(self, x0, y0, x1, y1):
+        """Return list of cells in area x0:x1, y0:y1 with a blocking object."""
+        # Walk whichever is smaller: the area or the occupied cells.
+        if (x1 - x0) * (y1 - y0) > len(self._cells):
+            cells = [(pos, cell) for pos, cell in self._cells.items()
+                     if x0 <= pos[0] < x1 and y0 <= pos[1] < y1]
+        else:
+            cells = [((x, y), self._cells[x, y])
+                     for x in range(x0, x1) for y in range(y0, y1)
+                     if (x, y) in self._cells]
+        return [pos for pos, cell in cells
+                if any(obj.blocks for obj in cell)]
+
+    def at(self, x, y):
+        """Return list of objects at coords."""
+        return list(self._cells.get((x, y), ()))
+
+    def blocking_at(self, x, y):
+        """Return the blocking object at coords, or None."""
+        for obj in self._cells.get((x, y), ()):
+            if obj.blocks:
+                return obj
+        return None
+
+    def within(self, x, y, radius):
+        """Return list of objects within radius of coords."""
+        found = []
+        r = int(math.floor(radius))
+        # Walk whichever is smaller: the square around the point or the
+        # occupied cells.
+        if (2 * r + 1) ** 2 > len(self._cells):
+            for (cx, cy), cell in self._cells.items():
+                if (cx - x) ** 2 + (cy - y) ** 2 <= radius ** 2:
+                    found.extend(cell)
+            return found
+        for cx in range(x - r, x + r + 1):
+            for cy in range(y - r, y + r + 1):
+                cell = self._cells.get((cx, cy))
+                if cell and (cx - x) ** 2 + (cy - y) ** 2 <= radius ** 2:
+                    found.extend(cell)
+        return found
+
+    def fighters_within(self, x, y, radius):
+        """Return list of objects with a fighter within radius of coords."""
+        return [obj for obj in self.within(x, y, radius) if obj.fighter]